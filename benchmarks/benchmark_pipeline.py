@@ -0,0 +1,311 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import threading
+import tracemalloc
+import subprocess
+import warnings
+import numpy as np
+import pandas as pd
+import psutil
+
+# Benchmark av EnergyAnalysis på syntetiske byggtabeller (1k, 10k, 100k bygg), helt uten nett.
+# Hver størrelse kjøres i en egen prosess i benchmarks/work/, og resultatet skrives som JSON.
+#
+#   python benchmarks/benchmark_pipeline.py
+#   python benchmarks/benchmark_pipeline.py --sizes 1000 10000 --dtype float32 --baseline benchmarks/baseline.json
+
+ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_FOLDER = os.path.join(ROOT_FOLDER, "benchmarks", "work")
+REPORT_FILE = os.path.join(ROOT_FOLDER, "benchmarks", "report.json")
+SOURCE_BUILDING_TABLE = os.path.join(ROOT_FOLDER, "input", "building_table_østmarka.xlsx")
+SOURCE_TEMPERATURE_FILE = os.path.join(ROOT_FOLDER, "input", "utetemperatur.xlsx")
+SOURCE_PROFET_DATA = os.path.join(ROOT_FOLDER, "src", "profet_data.csv")
+SIZES = [1000, 10000, 100000]
+
+BUILDING_TYPES = ["Hus", "Leilighet", "Kontor", "Butikk", "Hotell", "Barnehage", "Skole", "Universitet", "Kultur", "Sykehjem", "Sykehus", "Andre"]
+ENERGY_AREAS = [f"omraade{i:02d}" for i in range(1, 21)]
+# scenariokoder per scenario, trukket per energiområde og bygningstype
+SCENARIO_CODES = {
+    "Referansesituasjon": ["V00", "V00", "V20", "G10", "F10", "S10"],
+    "Energiforsyning (2030)": ["G50", "V30_S20", "F40", "G30_O20", "V00", "T10_E10"],
+    "Energiforsyning (2035)": ["G70_S50", "F60_S30", "V40_O40", "G50_T10", "S50"],
+    "Energiforsyning (2040)": ["G100_S100", "F80_S60", "G60_V40_S80", "O60_S100_E20"],
+    }
+METERED_SHARE = 0.02
+
+#-- syntetiske inndata
+def synthetic_building_table(n_buildings, seed):
+    rng = np.random.default_rng(seed)
+    sheets = pd.read_excel(SOURCE_BUILDING_TABLE, sheet_name = None)
+    source_df = next(iter(sheets.values()))
+    address_keys = list(sheets.keys())[1:]
+    # bygningstype, byggeår og areal trekkes fra den ekte tabellen, så blandingen blir realistisk
+    sample = source_df.iloc[rng.integers(0, len(source_df), n_buildings)].reset_index(drop = True)
+    area = np.maximum(np.round(sample["BRUKSAREAL_TOTALT"].to_numpy() * rng.lognormal(0, 0.3, n_buildings)), 30)
+    area[rng.random(n_buildings) < 0.01] = 0 # bygg uten areal fjernes i import_xlsx
+    unmetered_addresses = source_df.loc[~source_df["har_adresse"].isin(address_keys), "har_adresse"].unique()
+    metered = rng.random(n_buildings) < METERED_SHARE
+    df = pd.DataFrame({
+        "OBJECTID": rng.permutation(n_buildings) + 1,
+        "BYGNING_ID": rng.integers(1000000, 9999999, n_buildings),
+        "BYGNINGSTYPE_NAVN": sample["BYGNINGSTYPE_NAVN"],
+        "BRUKSAREAL_TOTALT": area,
+        "ANTALL_ETASJER": sample["ANTALL_ETASJER"],
+        "BEBYGD_AREAL": sample["BEBYGD_AREAL"],
+        "ENERGIOMRAADEID": rng.choice(ENERGY_AREAS, n_buildings),
+        "TATT_I_BRUK": sample["TATT_I_BRUK"],
+        "BYGNINGSOMRAADEID": sample["BYGNINGSOMRAADEID"],
+        "y": source_df["y"].min() + rng.random(n_buildings) * (source_df["y"].max() - source_df["y"].min()),
+        "x": source_df["x"].min() + rng.random(n_buildings) * (source_df["x"].max() - source_df["x"].min()),
+        "har_fjernvarme": np.nan,
+        "har_grunnvarme": np.nan,
+        "har_adresse": np.where(metered, rng.choice(address_keys, n_buildings), rng.choice(unmetered_addresses, n_buildings)),
+        })
+    return df, {key: sheets[key] for key in address_keys}
+
+def write_building_table(file_path, n_buildings, seed):
+    df, address_sheets = synthetic_building_table(n_buildings, seed)
+    with pd.ExcelWriter(file_path) as writer:
+        df.to_excel(writer, sheet_name = "Bygningstabell", index = False)
+        for key, address_df in address_sheets.items():
+            address_df.to_excel(writer, sheet_name = key, index = False)
+
+def write_scenario_file(file_path, seed):
+    rng = np.random.default_rng(seed)
+    with pd.ExcelWriter(file_path) as writer:
+        for scenario_name, codes in SCENARIO_CODES.items():
+            df = pd.DataFrame(rng.choice(codes, (len(ENERGY_AREAS), len(BUILDING_TYPES))), index = ENERGY_AREAS, columns = BUILDING_TYPES)
+            df.to_excel(writer, sheet_name = scenario_name)
+
+def write_profet_data(work_folder):
+    # PROFet-profilene hentes fra den lokale erstatningen hvis src/profet_data.csv ikke finnes
+    sys.path.insert(0, ROOT_FOLDER)
+    from energyanalysis import EnergyAnalysis
+    from profet_standin import start_standin_server
+    server, base_url = start_standin_server()
+    try:
+        energy_analysis = EnergyAnalysis(
+            building_table = None,
+            energy_area_id = "energiomraadeid",
+            building_area_id = "bygningsomraadeid",
+            scenario_file_name = None,
+            temperature_array_file_path = "input/utetemperatur.xlsx",
+            profet_token_url = f"{base_url}/connect/token",
+            profet_api_url = f"{base_url}/api/Profet"
+            )
+        shutil.copy(os.path.join(ROOT_FOLDER, "src", "secret.txt"), os.path.join(work_folder, "src", "secret.txt"))
+        energy_analysis.main_preprocess_profet()
+    finally:
+        server.shutdown()
+
+def prepare_work_folder(sizes, seed):
+    for folder in ["input", "src", "output"]:
+        os.makedirs(os.path.join(WORK_FOLDER, folder), exist_ok = True)
+    os.chdir(WORK_FOLDER)
+    shutil.copy(SOURCE_TEMPERATURE_FILE, "input/utetemperatur.xlsx")
+    shutil.copy(os.path.join(ROOT_FOLDER, "src", "solenergi_antakelser.csv"), "src/solenergi_antakelser.csv")
+    if os.path.exists(SOURCE_PROFET_DATA):
+        shutil.copy(SOURCE_PROFET_DATA, "src/profet_data.csv")
+    elif not os.path.exists("src/profet_data.csv"):
+        print("src/profet_data.csv mangler, henter profiler fra PROFet-erstatningen")
+        write_profet_data(WORK_FOLDER)
+    if not os.path.exists(f"input/scenarier_{seed}.xlsx"):
+        write_scenario_file(f"input/scenarier_{seed}.xlsx", seed)
+    for n_buildings in sizes:
+        # tabellene gjenbrukes mellom kjøringer, det tar tid å skrive store Excel-filer
+        if not os.path.exists(f"input/bygg_{n_buildings}_{seed}.xlsx"):
+            print(f"Lager syntetisk byggtabell med {n_buildings} bygg")
+            write_building_table(f"input/bygg_{n_buildings}_{seed}.xlsx", n_buildings, seed)
+
+#-- måling per steg
+class StageTimer:
+    def __init__(self, interval = 0.02):
+        self.process = psutil.Process()
+        self.interval = interval
+        self.stages = []
+        self.open_stages = [] # eksporten måles inne i run_simulation
+
+    def __sample_rss(self, stop_event, peak):
+        while not stop_event.wait(self.interval):
+            peak[0] = max(peak[0], self.process.memory_info().rss)
+
+    def __update_traced_peak(self):
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        for open_stage in self.open_stages:
+            open_stage["traced_peak"] = max(open_stage["traced_peak"], traced_peak)
+
+    def run(self, name, function, **kwargs):
+        peak = [self.process.memory_info().rss]
+        stop_event = threading.Event()
+        sampler = threading.Thread(target = self.__sample_rss, args = (stop_event, peak), daemon = True)
+        sampler.start()
+        self.__update_traced_peak()
+        tracemalloc.reset_peak() # toppen for åpne steg er tatt vare på over
+        open_stage = {"traced_start": tracemalloc.get_traced_memory()[0], "traced_peak": 0}
+        self.open_stages.append(open_stage)
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        try:
+            result = function(**kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            cpu_seconds = time.process_time() - cpu_start
+            self.__update_traced_peak()
+            self.open_stages.pop()
+            stop_event.set()
+            sampler.join()
+            peak[0] = max(peak[0], self.process.memory_info().rss)
+        self.stages.append({
+            "stage": name,
+            "seconds": round(seconds, 4),
+            "cpu_seconds": round(cpu_seconds, 4),
+            "peak_traced_mb": round((open_stage["traced_peak"] - open_stage["traced_start"]) / 2**20, 1),
+            "peak_rss_mb": round(peak[0] / 2**20, 1)
+            })
+        print(f"  {name:<28}{seconds:>9.2f} s{peak[0] / 2**20:>9.0f} MB")
+        return result
+
+def hourly_bytes(n_buildings, dtype):
+    from energyanalysis import EnergyAnalysis
+    return n_buildings * 8760 * len(EnergyAnalysis.HOURLY_DATA_FIELDS) * np.dtype(dtype).itemsize
+
+def run_size(n_buildings, seed, dtype, streaming, hourly_format):
+    sys.path.insert(0, ROOT_FOLDER)
+    os.chdir(WORK_FOLDER)
+    from energyanalysis import EnergyAnalysis
+    warnings.simplefilter(action = "ignore")
+    # timeverdiene for alle bygg må få plass i minnet, ellers strømmes de til disk
+    if not streaming and hourly_bytes(n_buildings, dtype) > 0.5 * psutil.virtual_memory().available:
+        print(f"  timeverdiene for {n_buildings} bygg får ikke plass i minnet, kjører med streaming")
+        streaming = True
+    energy_analysis = EnergyAnalysis(
+        building_table = f"bygg_{n_buildings}_{seed}.xlsx",
+        energy_area_id = "energiomraadeid",
+        building_area_id = "bygningsomraadeid",
+        scenario_file_name = f"input/scenarier_{seed}.xlsx",
+        temperature_array_file_path = "input/utetemperatur.xlsx",
+        hourly_data_format = hourly_format,
+        seed = seed,
+        dtype = dtype,
+        streaming = streaming
+        )
+    shutil.rmtree(os.path.join(energy_analysis.CACHE_FOLDER, "workbooks"), ignore_errors = True)
+    timer = StageTimer()
+    def run_simulation(name, **kwargs):
+        # eksporten (timedata og csv, også delene ved streaming) skjer inne i run_simulation;
+        # den hentes fra motorens egne "export"-steg i run_report og oppgis som eget steg
+        records = len(energy_analysis.run_report.records)
+        result = timer.run(name, energy_analysis.run_simulation, **kwargs)
+        export_records = [record for record in energy_analysis.run_report.records[records:] if record["stage"] == "export"]
+        simulation_stage = timer.stages[-1]
+        export_stage = {
+            "stage": name.replace("run_simulation", "export"),
+            "seconds": round(sum(record["seconds"] for record in export_records), 4),
+            "cpu_seconds": round(sum(record["cpu_seconds"] for record in export_records), 4),
+            "peak_rss_mb": max([record["peak_rss_mb"] for record in export_records], default = 0.0),
+            "calls": len(export_records)
+            }
+        timer.stages.insert(len(timer.stages) - 1, export_stage)
+        print(f"  {'  herav ' + export_stage['stage']:<28}{export_stage['seconds']:>9.2f} s{export_stage['peak_rss_mb']:>9.0f} MB")
+        simulation_stage["seconds_without_export"] = round(simulation_stage["seconds"] - export_stage["seconds"], 4)
+        return result
+    tracemalloc.start()
+    timer.run("load_reference_data", lambda: (energy_analysis.PROFET_DATA, energy_analysis.SOLARPANEL_DATA))
+    timer.run("import_xlsx (kald)", energy_analysis.import_xlsx)
+    df = timer.run("import_xlsx (cachet)", energy_analysis.import_xlsx)
+    timer.run("preprocess_ashp", energy_analysis.main_preprocess_ashp)
+    energy_dicts_of_dicts = [pd.read_excel(f"input/scenarier_{seed}.xlsx", sheet_name = scenario_name, index_col = 0).T.to_dict() for scenario_name in SCENARIO_CODES]
+    scenario_names = list(SCENARIO_CODES)
+    rng = np.random.default_rng(seed)
+    reference_df = timer.run("create_scenario", energy_analysis.create_scenario, df = df, energy_dicts = energy_dicts_of_dicts[0], rng = rng)
+    reference_df = run_simulation("run_simulation", df = reference_df, scenario_name = scenario_names[0], test = False)
+    modified_df = timer.run("modify_scenario", energy_analysis.modify_scenario, df = reference_df, energy_dicts = energy_dicts_of_dicts[1], rng = rng)
+    run_simulation("run_simulation (endret)", df = modified_df, scenario_name = scenario_names[1], test = False)
+    tracemalloc.stop()
+    return {
+        "buildings": n_buildings,
+        "buildings_after_import": len(df),
+        "streaming": streaming,
+        "hourly_mb": round(hourly_bytes(len(df), dtype) / 2**20, 1),
+        "total_seconds": round(sum(stage["seconds"] for stage in timer.stages if not stage["stage"].startswith("export")), 4),
+        "peak_rss_mb": max(stage["peak_rss_mb"] for stage in timer.stages),
+        "stages": timer.stages
+        }
+
+#-- rapport
+def compare_to_baseline(report, baseline_file, tolerance):
+    with open(baseline_file, encoding = "utf-8") as file:
+        baseline = json.load(file)
+    baseline_stages = {(size["buildings"], stage["stage"]): stage for size in baseline["sizes"] for stage in size["stages"]}
+    regressions = []
+    for size in report["sizes"]:
+        for stage in size["stages"]:
+            baseline_stage = baseline_stages.get((size["buildings"], stage["stage"]))
+            if baseline_stage is None:
+                continue
+            for key in ["seconds", "peak_rss_mb"]:
+                if key == "seconds" and baseline_stage[key] < 0.5:
+                    continue # for korte steg til å sammenligne
+                ratio = stage[key] / baseline_stage[key]
+                if ratio > 1 + tolerance:
+                    regressions.append({"buildings": size["buildings"], "stage": stage["stage"], "metric": key, "baseline": baseline_stage[key], "value": stage[key], "ratio": round(ratio, 2)})
+    return regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark av EnergyAnalysis på syntetiske byggtabeller")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = SIZES)
+    parser.add_argument("--seed", type = int, default = 42)
+    parser.add_argument("--dtype", choices = ["float64", "float32"], default = "float64")
+    parser.add_argument("--streaming", action = "store_true")
+    parser.add_argument("--hourly-format", choices = ["parquet", "csv"], default = "parquet")
+    parser.add_argument("--output", default = REPORT_FILE, help = "JSON-rapport")
+    parser.add_argument("--baseline", help = "tidligere rapport å sammenligne med")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "tillatt økning mot baseline, 0.2 = 20 %%")
+    parser.add_argument("--single-size", type = int, help = argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.single_size is not None:
+        # kjøres i egen prosess, slik at minnemålingen for en størrelse ikke påvirkes av den forrige
+        result = run_size(args.single_size, args.seed, args.dtype, args.streaming, args.hourly_format)
+        print(json.dumps(result))
+        return
+
+    prepare_work_folder(args.sizes, args.seed)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "memory_mb": round(psutil.virtual_memory().total / 2**20),
+        "options": {"seed": args.seed, "dtype": args.dtype, "streaming": args.streaming, "hourly_format": args.hourly_format},
+        "sizes": []
+        }
+    for n_buildings in args.sizes:
+        print(f"{n_buildings} bygg")
+        command = [sys.executable, os.path.abspath(__file__), "--single-size", str(n_buildings), "--seed", str(args.seed), "--dtype", args.dtype, "--hourly-format", args.hourly_format]
+        if args.streaming:
+            command.append("--streaming")
+        completed = subprocess.run(command, stdout = subprocess.PIPE, text = True, check = True)
+        lines = completed.stdout.rstrip().splitlines()
+        print("\n".join(lines[:-1]))
+        report["sizes"].append(json.loads(lines[-1]))
+    if args.baseline:
+        report["regressions"] = compare_to_baseline(report, args.baseline, args.tolerance)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok = True)
+    with open(args.output, "w", encoding = "utf-8") as file:
+        json.dump(report, file, indent = 2, ensure_ascii = False)
+    print(f"Rapport skrevet til {args.output}")
+    if report.get("regressions"):
+        for regression in report["regressions"]:
+            print(f"Regresjon: {regression['buildings']} bygg, {regression['stage']}, {regression['metric']} {regression['baseline']} -> {regression['value']}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import calendar
+import numpy as np
+
+# Aggregering av timeserier (serier x timer) per dag, uke eller måned i ett kall.
+# Periodene følger kalenderen for valgt år, så skuddår (8784 timer) gir riktig februar og resten av året.
+
+AGGREGATIONS = ["sum", "max", "min", "average"]
+FREQUENCIES = ["day", "week", "month"]
+YEAR = 2022 # samme år som "StartDate" i PROFet-forespørselen (energyanalysis.py), normalår med 8760 timer som starter på en lørdag
+
+def hours_in_year(year = YEAR):
+    return 8784 if calendar.isleap(year) else 8760
+
+def period_starts(frequency = "month", year = YEAR):
+    # første time i hver periode; uker starter mandag, første uke kan være kortere
+    hours = np.datetime64(f"{year}-01-01T00", "h") + np.arange(hours_in_year(year))
+    if frequency == "month":
+        periods = hours.astype("datetime64[M]").astype(int)
+    elif frequency == "day":
+        periods = hours.astype("datetime64[D]").astype(int)
+    elif frequency == "week":
+        days = hours.astype("datetime64[D]").astype(int)
+        periods = (days - days[0] + calendar.weekday(year, 1, 1)) // 7
+    else:
+        raise ValueError(f"Ukjent periode '{frequency}', bruk en av {FREQUENCIES}")
+    return np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+
+def aggregate(array, frequency = "month", aggregations = ("sum", "max", "average"), year = YEAR):
+    # array er (timer,) eller (serier, timer); gir {aggregering: (serier, perioder)}. NaN telles som 0
+    array = np.asarray(array, dtype = float)
+    one_series = array.ndim == 1
+    array = np.nan_to_num(np.atleast_2d(array), nan = 0.0)
+    if array.shape[1] != hours_in_year(year):
+        raise ValueError(f"Serien har {array.shape[1]} timer, men {year} har {hours_in_year(year)}")
+    starts = period_starts(frequency, year)
+    result = {}
+    for aggregation in aggregations:
+        if aggregation == "sum":
+            result[aggregation] = np.add.reduceat(array, starts, axis = 1)
+        elif aggregation == "max":
+            result[aggregation] = np.maximum.reduceat(array, starts, axis = 1)
+        elif aggregation == "min":
+            result[aggregation] = np.minimum.reduceat(array, starts, axis = 1)
+        elif aggregation == "average":
+            lengths = np.diff(np.r_[starts, array.shape[1]])
+            result[aggregation] = (result["sum"] if "sum" in result else np.add.reduceat(array, starts, axis = 1)) / lengths
+        else:
+            raise ValueError(f"Ukjent aggregering '{aggregation}', bruk en av {AGGREGATIONS}")
+    if one_series:
+        result = {aggregation: values[0] for aggregation, values in result.items()}
+    return result
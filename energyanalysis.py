@@ -1,13 +1,121 @@
 import pandas as pd
 import numpy as np
-from requests_oauthlib import OAuth2Session
-from oauthlib.oauth2 import BackendApplicationClient
 import time
-import random
-import swifter
-import streamlit as st
-from sklearn.linear_model import LinearRegression
+import os
+import hashlib
+import json
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import re
+import argparse
 import warnings
+import contextlib
+from workbook_cache import read_workbook
+
+class _LazyCsv:
+    # referansedata leses først ved bruk (ikke ved import), og kan overstyres per instans
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.data = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is not None and self.name in instance.__dict__:
+            return instance.__dict__[self.name]
+        if self.data is None:
+            self.data = pd.read_csv(self.file_path, sep = ";")
+        return self.data
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+def _peak_rss():
+    # Linux: VmHWM, som kan nullstilles per steg. Ellers RSS ved slutten av steget
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import psutil
+    return psutil.Process().memory_info().rss
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+class _RunReport:
+    # veggtid, CPU-tid, rader og topp-RSS per steg, per scenario og chunk
+    def __init__(self):
+        self.records = []
+        self.scenario = None
+        self.open_stages = []
+
+    def __update_peak(self):
+        peak = _peak_rss()
+        for open_stage in self.open_stages:
+            open_stage["peak"] = max(open_stage["peak"], peak)
+
+    @contextlib.contextmanager
+    def stage(self, name, rows = None, chunk = None, scenario = None):
+        previous_scenario = self.scenario
+        if scenario is not None:
+            self.scenario = scenario
+        self.__update_peak() # toppen for ytre steg tas vare på før nullstilling
+        _reset_peak_rss()
+        open_stage = {"peak": 0, "rows": rows, "invalid": None} # rows kan settes i steget hvis antallet ikke er kjent på forhånd, invalid er antall bygg som ikke kunne beregnes
+        self.open_stages.append(open_stage)
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        try:
+            yield open_stage
+        finally:
+            seconds = time.perf_counter() - start
+            cpu_seconds = time.process_time() - cpu_start
+            self.__update_peak()
+            self.open_stages.pop()
+            self.records.append({
+                "scenario": self.scenario,
+                "stage": name,
+                "chunk": chunk,
+                "rows": open_stage["rows"],
+                "invalid": open_stage["invalid"],
+                "seconds": round(seconds, 4),
+                "cpu_seconds": round(cpu_seconds, 4),
+                "peak_rss_mb": round(open_stage["peak"] / 2**20, 1),
+                "pid": os.getpid()
+                })
+            self.scenario = previous_scenario
+
+    def summary(self):
+        # summert per scenario og steg, chunkene slås sammen
+        summary = {}
+        for record in self.records:
+            key = (record["scenario"], record["stage"])
+            if key not in summary:
+                summary[key] = {"scenario": record["scenario"], "stage": record["stage"], "calls": 0, "rows": 0, "invalid": 0, "seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": 0.0}
+            summary[key]["calls"] += 1
+            summary[key]["rows"] += record["rows"] or 0
+            summary[key]["invalid"] += record.get("invalid") or 0
+            summary[key]["seconds"] = round(summary[key]["seconds"] + record["seconds"], 4)
+            summary[key]["cpu_seconds"] = round(summary[key]["cpu_seconds"] + record["cpu_seconds"], 4)
+            summary[key]["peak_rss_mb"] = max(summary[key]["peak_rss_mb"], record["peak_rss_mb"])
+        return list(summary.values())
+
+    def write(self, file_path, options):
+        report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "options": options, "summary": self.summary(), "stages": self.records}
+        with open(f"{file_path}.{os.getpid()}.tmp", "w", encoding = "utf-8") as file:
+            json.dump(report, file, indent = 2, ensure_ascii = False)
+        os.replace(f"{file_path}.{os.getpid()}.tmp", file_path)
 
 class EnergyAnalysis:
     PROFET_BUILDINGSTANDARD = "profet_bygningsstandard"
@@ -28,8 +136,13 @@ class EnergyAnalysis:
             "TEK10/TEK17": "Eff-E", 
             "Passivhus": "Vef"
             }
+    # kategoriene sorteres alfabetisk, slik at groupby(sort=True) gir samme rekkefølge som med tekst
+    BUILDING_STANDARD_CATEGORIES = sorted(BUILDING_STANDARDS)
     
-    PROFET_DATA = pd.read_csv('src/profet_data.csv', sep = ";")
+    PROFET_DATA = _LazyCsv('src/profet_data.csv')
+    CACHE_FOLDER = "src/cache"
+    PROFET_TOKEN_URL = "https://identity.byggforsk.no/connect/token"
+    PROFET_API_URL = "https://flexibilitysuite.byggforsk.no/api/Profet"
 
     GSHP = 'grunnvarme'
     SOLAR_PANELS = 'solceller'
@@ -52,13 +165,26 @@ class EnergyAnalysis:
     DISTRICT_HEATING_PRODUCED = '_fjernvarmeproduksjon'
     SOLAR_PANELS_PRODUCED = '_solcelleproduksjon'
     GRID = '_nettutveksling'
+    HOURLY_DATA_FIELDS = [f'{GRID}_energi_liste', DHW_DEMAND, SPACEHEATING_DEMAND, ELECTRIC_DEMAND_FOR_CALCULATION, ELECTRIC_DEMAND, THERMAL_DEMAND_FOR_CALCULATION]
     
     HAS_WELL = 'har_grunnvarme'
     HAS_DISTRICTHEATING = 'har_fjernvarme'
     HAS_ADDRESS = 'har_adresse'
     HAS_EXISTING_DATA = 'har_eksisterende_data'
+    PERCENTAGE_CODE_MAP = {
+            "G" : GSHP,
+            "S" : SOLAR_PANELS,
+            "V" : ASHP,
+            "F" : DISTRICT_HEATING,
+            "O" : BUILDING_STANDARD_UPGRADED,
+            "T" : REDUCE_THERMAL_DEMAND,
+            "E" : REDUCE_ELECTRIC_DEMAND
+            }
+    MONTE_CARLO_PERCENTILES = [5, 25, 50, 75, 95]
+    # alt som påvirker beregningen av et bygg - likt som i referansesituasjonen gir like resultater
+    SIMULATION_SIGNATURE = [PROFET_BUILDINGTYPE, PROFET_BUILDINGSTANDARD, BUILDING_AREA, BEBYGD_AREA, STORIES, GSHP, ASHP, DISTRICT_HEATING, SOLAR_PANELS, BUILDING_STANDARD_UPGRADED, REDUCE_THERMAL_DEMAND, REDUCE_ELECTRIC_DEMAND, HAS_EXISTING_DATA, HAS_ADDRESS]
     
-    SOLARPANEL_DATA = pd.read_csv('src/solenergi_antakelser.csv', sep = ";")
+    SOLARPANEL_DATA = _LazyCsv('src/solenergi_antakelser.csv')
     
     BUILDING_TYPES = {
             "Hus": "Hou",
@@ -75,6 +201,26 @@ class EnergyAnalysis:
             "Andre": "Other"
         }
     
+    BUILDING_TYPE_CATEGORIES = sorted(BUILDING_TYPES)
+    
+    # nøkkelord i bygningstype_navn (små bokstaver), første treff i denne rekkefølgen gjelder
+    BUILDING_TYPE_KEYWORDS = {
+            "sykehus" : "Sykehus",
+            "helse" : "Sykehus",
+            "hotell" : "Hotell",
+            "barnehage" : "Barnehage",
+            "sykehjem" : "Sykehjem",
+            "behandling" : "Sykehjem",
+            "skole" : "Skole",
+            "kontor" : "Kontor",
+            "fritidsbygg" : "Hus",
+            "bofellesskap" : "Sykehjem",
+            "bolig": "Hus",
+            "hus": "Hus",
+        }
+    # én valgfri lookahead per nøkkelord: gruppe i er satt hvis nøkkelord i finnes et sted i navnet
+    BUILDING_TYPE_PATTERN = re.compile("^" + "".join(f"(?:(?=.*?({re.escape(keyword)})))?" for keyword in BUILDING_TYPE_KEYWORDS))
+    
     DEKNINGSGRADER_GSHP = {
             'Hus' : 100, 
             'Leilighet' : 95,
@@ -120,12 +266,29 @@ class EnergyAnalysis:
             'Andre' : 'Næringsbygg_mindre',
         }
     
-    def __init__(self, building_table, energy_area_id, building_area_id, scenario_file_name, temperature_array_file_path):
+    def __init__(self, building_table, energy_area_id, building_area_id, scenario_file_name, temperature_array_file_path, hourly_data_format = "parquet", workers = 1, incremental = False, seed = None, monte_carlo = 0, dtype = "float64", streaming = False, profet_concurrency = 8, profet_token_url = PROFET_TOKEN_URL, profet_api_url = PROFET_API_URL):
         self.BUILDING_TABLE = building_table
         self.ENERGY_AREA_ID = energy_area_id
         self.BUILDING_AREA_ID = building_area_id
         self.SCENARIO_FILE_NAME = scenario_file_name
         self.TEMPERATURE_ARRAY_FILE_NAME = temperature_array_file_path
+        self.HOURLY_DATA_FORMAT = hourly_data_format # "parquet" eller "csv"
+        self.WORKERS = workers # antall prosesser for scenarioene etter referansesituasjonen
+        self.INCREMENTAL = incremental # gjenbruk resultater fra referansesituasjonen for uendrede bygg
+        self.reference_result = None
+        self.SEED = seed # samme seed gir samme fordeling av tiltak
+        self.MONTE_CARLO = monte_carlo # antall trekninger per scenario, 0 = vanlig simulering
+        # lagringspresisjon for timeverdiene; beregning og KPI-er er alltid i float64.
+        # float32 halverer minnet, relativ avrunding per timeverdi er maks 2**-24 (ca. 6e-8)
+        self.DTYPE = np.dtype(dtype)
+        self.STREAMING = streaming # timeverdier skrives til disk per chunk i stedet for å samles i minnet
+        self.PROFET_CONCURRENCY = profet_concurrency # antall samtidige kall mot PROFet
+        self.PROFET_TOKEN_URL = profet_token_url
+        self.PROFET_API_URL = profet_api_url
+        self.__profet_lock = threading.Lock()
+        self.__profet_token = None
+        self.__profet_secret = None
+        self.run_report = _RunReport() # skrives til output/run_report.json av main
                 
     def __lower_column_names(self, df):
         df.rename(columns=lambda x: x.lower(), inplace=True)
@@ -136,63 +299,30 @@ class EnergyAnalysis:
         return df
         
     def __populate_profet_columns(self, df):
-        def assign_buildingstandard(row):
-            if row[self.PROFET_DATE].year <= 2007:
-                return "Eldre"
-            elif row[self.PROFET_DATE].year > 2022:
-                return "Passivhus"
-            elif row[self.PROFET_DATE].year > 2007 and row[self.PROFET_DATE].year <= 2022:
-                return "TEK10/TEK17"
-            
-        def map_values(input_string):
-            for key, value in mapping_dict.items():
-                if key in input_string:
-                    return value
-            return None
-        
-        unique_buildings = df[self.BUILDING_TYPE].unique()
-        unique_buildings = [unique_building for unique_building in unique_buildings if isinstance(unique_building, str)]
-        mapping_dict = {
-            "sykehus" : "Sykehus",
-            "helse" : "Sykehus",
-            "hotell" : "Hotell",
-            "barnehage" : "Barnehage",
-            "sykehjem" : "Sykehjem",
-            "behandling" : "Sykehjem",
-            "skole" : "Skole",
-            "kontor" : "Kontor",
-            "fritidsbygg" : "Hus",
-            "bofellesskap" : "Sykehjem",
-            "bolig": "Hus",
-            "hus": "Hus",
-        }
-        unique_buildings = [string.lower() for string in unique_buildings] # list 2
-        mapped_values = [map_values(string) for string in unique_buildings] # list 1
-        building_map = {}
-        for item1, item2 in zip(unique_buildings, mapped_values):
-            if item1 is not None:
-                if item1 in building_map:
-                    building_map[item1].append(item2)
-                else:
-                    building_map[item1] = [item2]
-        building_map = {key: value[0].strip('[]') if value and isinstance(value[0], str) else value[0] for key, value in building_map.items()}
-        capitalized_map = {key.capitalize(): value for key, value in building_map.items()}
-        df[self.PROFET_BUILDINGTYPE] = df[self.BUILDING_TYPE].map(capitalized_map)
-        df[self.PROFET_DATE] = pd.to_datetime(df[self.BUILDING_YEAR], format='%Y%m%d', errors='coerce', exact=False)
-        df[self.PROFET_BUILDINGSTANDARD] = df.apply(assign_buildingstandard, axis=1)
-        return df
-    
-    def __drop_null_rows(self, df):
-        df = df[df[self.BUILDING_AREA] != 0]
+        # standard fra byggeår, bygningstype fra første nøkkelord i BUILDING_TYPE_KEYWORDS som finnes i navnet
+        year = pd.to_datetime(df[self.BUILDING_YEAR], format='%Y%m%d', errors='coerce', exact=False).dt.year
+        building_standard = np.select([year <= 2007, year > 2022, year > 2007], ["Eldre", "Passivhus", "TEK10/TEK17"], default=None)
+        df[self.PROFET_BUILDINGSTANDARD] = pd.Categorical(building_standard, categories=self.BUILDING_STANDARD_CATEGORIES)
+        #--
+        unique_buildings = pd.Series([unique_building for unique_building in df[self.BUILDING_TYPE].unique() if isinstance(unique_building, str)], dtype=object)
+        lowered = unique_buildings.str.lower()
+        keywords = lowered.str.extract(self.BUILDING_TYPE_PATTERN).bfill(axis=1).iloc[:, 0]
+        # kun navn skrevet som "Stor forbokstav resten små" blir gjenkjent, som før
+        recognized = (unique_buildings == lowered.str.capitalize()).to_numpy()
+        building_map = dict(zip(unique_buildings[recognized], keywords[recognized].map(self.BUILDING_TYPE_KEYWORDS)))
+        df[self.PROFET_BUILDINGTYPE] = pd.Categorical(df[self.BUILDING_TYPE].map(building_map), categories=self.BUILDING_TYPE_CATEGORIES)
+        df[self.ENERGY_AREA_ID] = df[self.ENERGY_AREA_ID].astype("category")
+        df[self.BUILDING_AREA_ID] = df[self.BUILDING_AREA_ID].astype("category")
         return df
     
     def __if_not_profet_categories(self, df):
-        df[self.PROFET_BUILDINGTYPE].fillna('Andre', inplace=True)
-        df[self.PROFET_BUILDINGSTANDARD].fillna('Eldre', inplace=True)
+        df[self.PROFET_BUILDINGTYPE] = df[self.PROFET_BUILDINGTYPE].fillna('Andre')
+        df[self.PROFET_BUILDINGSTANDARD] = df[self.PROFET_BUILDINGSTANDARD].fillna('Eldre')
         return df
     
     def __cleanup_columns(self, df):
-        df = df[[
+        # bygg uten areal og kolonner som ikke brukes tas ut i samme kopi
+        df = df.loc[df[self.BUILDING_AREA] != 0, [
             self.OBJECT_ID,
             self.ENERGY_AREA_ID,
             self.BUILDING_AREA_ID,
@@ -212,32 +342,28 @@ class EnergyAnalysis:
         return df
     
     def __area_sort(self, df):
-        df = df.sort_values(by=[self.BUILDING_AREA], ascending=[False])
-        df = df.reset_index(drop = True)
+        df = df.sort_values(by=[self.BUILDING_AREA], ascending=[False], ignore_index=True)
         return df
      
-    def __read_xlsx(self):
-        df = pd.read_excel(f"input/{self.BUILDING_TABLE}")
-        return df
-    
     def __read_xlsx_sheets(self):
-        df = pd.read_excel(f"input/{self.BUILDING_TABLE}", sheet_name=None)
+        # første ark er byggtabellen, resten er målte adresser
+        df = read_workbook(f"input/{self.BUILDING_TABLE}", cache_folder = f"{self.CACHE_FOLDER}/workbooks")
         self.address_dict = df 
         keys = list(df.keys())
         keys.pop(0)
         self.address_keys = keys
+        return df
         #for key in keys:
         #    st.write(key)
         #    st.write(df[key])
         #return sheet  
     
     def import_xlsx(self):
-        self.__read_xlsx_sheets()
-        df = self.__read_xlsx()
+        sheets = self.__read_xlsx_sheets()
+        df = next(iter(sheets.values())).copy()
         df = self.__lower_column_names(df)
         df = self.__replace_null(df)
         df = self.__populate_profet_columns(df)
-        df = self.__drop_null_rows(df)
         df = self.__if_not_profet_categories(df)
         df = self.__cleanup_columns(df)
         df = self.__area_sort(df)            
@@ -245,9 +371,11 @@ class EnergyAnalysis:
     
     def __read_scenario_file_excel(self):
         variable_dict = {}
-        xls_keys = list(pd.read_excel(self.SCENARIO_FILE_NAME, sheet_name = None).keys())
+        sheets = read_workbook(self.SCENARIO_FILE_NAME, cache_folder = f"{self.CACHE_FOLDER}/workbooks")
+        xls_keys = list(sheets.keys())
         for key in xls_keys:
-            df = pd.read_excel(self.SCENARIO_FILE_NAME, sheet_name = key, index_col=0)
+            df = sheets[key]
+            df = df.set_index(df.columns[0]) # første kolonne er energiområdeid
             df = df.T
             energy_dicts = df.to_dict()
             variable_dict[key] = energy_dicts
@@ -261,15 +389,25 @@ class EnergyAnalysis:
             secret = file.readline()
         return secret
         
+    def __get_profet_token(self):
+        # ett token deles av alle kall til det nesten har gått ut
+        from requests_oauthlib import OAuth2Session
+        from oauthlib.oauth2 import BackendApplicationClient
+        with self.__profet_lock:
+            if self.__profet_token is None or self.__profet_token.get("expires_at", float("inf")) - 60 < time.time():
+                if self.__profet_secret is None:
+                    self.__profet_secret = self.__get_secret("src/secret.txt")
+                oauth = OAuth2Session(client=BackendApplicationClient(client_id="profet_2023"))
+                self.__profet_token = oauth.fetch_token(
+                    token_url=self.PROFET_TOKEN_URL,
+                    client_id="profet_2023",
+                    client_secret=self.__profet_secret,
+                )
+            return self.__profet_token
+
     def __profet_api(self, building_standard, building_type, area, temperature_array):
-        oauth = OAuth2Session(client=BackendApplicationClient(client_id="profet_2023"))
-        predict = OAuth2Session(
-            token=oauth.fetch_token(
-                token_url="https://identity.byggforsk.no/connect/token",
-                client_id="profet_2023",
-                client_secret=self.__get_secret("src/secret.txt"),
-            )
-        )
+        from requests_oauthlib import OAuth2Session
+        predict = OAuth2Session(token=self.__get_profet_token())
         selected_standard = self.BUILDING_STANDARDS[building_standard]
         if selected_standard == "Reg":
             regular_area, efficient_area, veryefficient_area = area, 0, 0
@@ -290,10 +428,10 @@ class EnergyAnalysis:
             "Areas": {f"{self.BUILDING_TYPES[building_type]}": {"Reg": regular_area, "Eff-E": efficient_area, "Eff-N": 0, "Vef": veryefficient_area}},
             "RetInd": False,  # Boolean, if True, individual profiles for each category and efficiency level are returned
             "Country": "Norway",  # Optional, possiblity to get automatic holiday flags from the python holiday library.
-            "TimeSeries": {"Tout": temperature_array}}
+            "TimeSeries": {"Tout": np.asarray(temperature_array, dtype=float).tolist()}}
             
         r = predict.post(
-            "https://flexibilitysuite.byggforsk.no/api/Profet", json=request_data
+            self.PROFET_API_URL, json=request_data
         )
         if r.status_code == 200:
             df = pd.DataFrame.from_dict(r.json())
@@ -305,19 +443,33 @@ class EnergyAnalysis:
             return dhw_demand, spaceheating_demand, electric_demand
         else:
             raise TypeError("PROFet virker ikke")
+
+    def __profet_profile(self, building_type, building_standard, temperature_array, temperature_hash):
+        # disk-cache per (endepunkt, bygningstype, standard, temperaturserie), PROFet kalles kun ved bom.
+        # egen undermappe per API-URL, slik at profiler fra profet_standin.py aldri leses inn ved kjøring mot Byggforsk
+        endpoint_hash = hashlib.sha256(self.PROFET_API_URL.encode("utf-8")).hexdigest()[:12]
+        cache_file = f"{self.CACHE_FOLDER}/profet/{endpoint_hash}/{self.BUILDING_TYPES[building_type]}_{self.BUILDING_STANDARDS[building_standard]}_{temperature_hash}.npy"
+        if not os.path.exists(cache_file):
+            dhw_demand, spaceheating_demand, electric_demand = self.__profet_api(building_standard = building_standard, building_type = building_type, area = 1, temperature_array = temperature_array)
+            profile = np.vstack([dhw_demand.flatten(), spaceheating_demand.flatten(), electric_demand.flatten()]).astype(float)
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            np.save(f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp.npy", profile)
+            os.replace(f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp.npy", cache_file)
+        return np.load(cache_file)
         
     def preprocess_profet_data(self, temperature_array):
-        result_df = pd.DataFrame()
-        for building_type in self.BUILDING_TYPES:
-            for building_standard in self.BUILDING_STANDARDS:
-                dhw_demand, spaceheating_demand, electric_demand = self.__profet_api(building_standard = building_standard, building_type = building_type, area = 1, temperature_array = temperature_array)
-                dhw_col_name = f"{building_type}_{building_standard}_DHW"
-                spaceheating_col_name = f"{building_type}_{building_standard}_SPACEHEATING"
-                electric_col_name = f"{building_type}_{building_standard}_ELECTRIC"
-                result_df[dhw_col_name] = dhw_demand.flatten()
-                result_df[spaceheating_col_name] = spaceheating_demand.flatten()
-                result_df[electric_col_name] = electric_demand.flatten()
+        temperature_hash = hashlib.sha256(np.asarray(temperature_array, dtype=float).tobytes()).hexdigest()[:16]
+        keys = [(building_type, building_standard) for building_type in self.BUILDING_TYPES for building_standard in self.BUILDING_STANDARDS]
+        with ThreadPoolExecutor(max_workers = self.PROFET_CONCURRENCY) as executor:
+            profiles = list(executor.map(lambda key: self.__profet_profile(building_type = key[0], building_standard = key[1], temperature_array = temperature_array, temperature_hash = temperature_hash), keys))
+        result = {}
+        for (building_type, building_standard), (dhw_demand, spaceheating_demand, electric_demand) in zip(keys, profiles):
+            result[f"{building_type}_{building_standard}_DHW"] = dhw_demand
+            result[f"{building_type}_{building_standard}_SPACEHEATING"] = spaceheating_demand
+            result[f"{building_type}_{building_standard}_ELECTRIC"] = electric_demand
+        result_df = pd.DataFrame(result)
         result_df.to_csv("src/profet_data.csv", sep = ";")
+        self.PROFET_DATA = result_df
         return result_df
     
     def preprocess_luft_luft_varmepumpe(self, temperature_array):
@@ -333,23 +485,24 @@ class EnergyAnalysis:
             [0.61, 0.82, 0.9],
             [0.55, 0.68, 0.82]
             ])
-        P_3031_list = []
-        COP_3031_list = []
-        for i in range(0, len(temperature_datapoints)):
-            P_3031_list.append(np.polyfit(x = temperature_datapoints, y = P_3031[i], deg = 1))
-            COP_3031_list.append(np.polyfit(x = temperature_datapoints, y = COP_3031[i], deg = 1))
-
-        self.P_HP_DICT = []
-        self.COP_HP_DICT = []
-        self.INTERPOLATE_HP_DICT = []
-        for index, outdoor_temperature in enumerate(temperature_array):
-            p_hp_list = np.array([np.polyval(P_3031_list[0], outdoor_temperature), np.polyval(P_3031_list[1], outdoor_temperature), np.polyval(P_3031_list[2], outdoor_temperature)])
-            cop_hp_list = np.array([np.polyval(COP_3031_list[0], outdoor_temperature), np.polyval(COP_3031_list[1], outdoor_temperature), np.polyval(COP_3031_list[2], outdoor_temperature)]) * COP_NOMINAL
-            interpolate_hp_list = np.polyfit(x = p_hp_list, y = cop_hp_list, deg = 0)[0]
-            #--
-            self.P_HP_DICT.append(p_hp_list)
-            self.COP_HP_DICT.append(cop_hp_list)
-            self.INTERPOLATE_HP_DICT.append(interpolate_hp_list)
+        temperature_array = np.asarray(temperature_array, dtype=float)
+        cache_key = hashlib.sha256(temperature_array.tobytes() + P_3031.tobytes() + COP_3031.tobytes() + str(COP_NOMINAL).encode()).hexdigest()[:16]
+        cache_file = f"{self.CACHE_FOLDER}/luft_luft_varmepumpe_{cache_key}.npy"
+        if not os.path.exists(cache_file):
+            P_3031_coefficients = np.polyfit(x = temperature_datapoints, y = P_3031.T, deg = 1)
+            COP_3031_coefficients = np.polyfit(x = temperature_datapoints, y = COP_3031.T, deg = 1)
+            # én rad per tabellkolonne: kapasitet (3), COP (3), interpolert COP (1)
+            table = np.empty((7, len(temperature_array)))
+            table[0:3] = P_3031_coefficients[0][:, None] * temperature_array + P_3031_coefficients[1][:, None]
+            table[3:6] = (COP_3031_coefficients[0][:, None] * temperature_array + COP_3031_coefficients[1][:, None]) * COP_NOMINAL
+            table[6] = np.mean(table[3:6], axis=0) # polyfit med grad 0 er gjennomsnittet
+            os.makedirs(self.CACHE_FOLDER, exist_ok=True)
+            np.save(f"{cache_file}.{os.getpid()}.tmp.npy", table)
+            os.replace(f"{cache_file}.{os.getpid()}.tmp.npy", cache_file)
+        table = np.load(cache_file, mmap_mode="r")
+        self.P_HP_TABLE = table[0:3].T
+        self.COP_HP_TABLE = table[3:6].T
+        self.INTERPOLATE_HP_TABLE = table[6]
             
     def __load_temperature_array(self):
         array = pd.read_excel(self.TEMPERATURE_ARRAY_FILE_NAME).to_numpy()
@@ -370,9 +523,9 @@ class EnergyAnalysis:
                 raise TypeError("Prosent kan ikke være over 100%")
         return number
     
-    def modify_scenario(self, df, energy_dicts):
+    def modify_scenario(self, df, energy_dicts, rng = None):
         table_no_entries = df.loc[(df[self.GSHP] == 0) & (df[self.DISTRICT_HEATING] == 0) & (df[self.ASHP] == 0) & (df[self.SOLAR_PANELS] == 0)]
-        new_df = self.create_scenario(df = table_no_entries, energy_dicts = energy_dicts)
+        new_df = self.create_scenario(df = table_no_entries, energy_dicts = energy_dicts, rng = rng)
         df = pd.concat([new_df, df])
         df = df.drop_duplicates(subset=self.OBJECT_ID, keep="first")
         df = df.sort_values(self.OBJECT_ID).reset_index(drop=True)
@@ -386,352 +539,384 @@ class EnergyAnalysis:
         return number
         #return round((number / (1000 * 1000)), 10)
         
-    def __predict_heating_demand(self, demand, temperature):
-        # Her kommer Åsmunds mesterverk:
-        df = pd.DataFrame({'Energi':demand, 'Temp':temperature})
-        df_without_heat = df.loc[(df['Temp'] >= 17.0)]
-        average_non_heat = np.average(df_without_heat['Energi'])
-        
-        electric_related_demand = np.zeros(len(df))
-        heating_related_demand = np.zeros(len(df))
-        
-        for i in range(0,len(df)):
-            if df['Energi'].iloc[i] >= average_non_heat:
-                electric_related_demand[i] = average_non_heat
-                heating_related_demand[i] = df['Energi'].iloc[i] - average_non_heat
-            else:
-                electric_related_demand[i] = df['Energi'].iloc[i]
-                heating_related_demand[i] = 0
-        
+    def predict_heating_demand_matrix(self, demand_matrix, temperature):
+        # Her kommer Åsmunds mesterverk, for alle målte bygg på en gang:
+        demand_matrix = np.atleast_2d(demand_matrix)
+        without_heat = np.asarray(temperature) >= 17.0
+        average_non_heat = np.average(demand_matrix[:, without_heat], axis=1)[:, None]
+        electric_related_demand = np.minimum(demand_matrix, average_non_heat)
+        heating_related_demand = np.clip(demand_matrix - average_non_heat, 0, None)
         return heating_related_demand, electric_related_demand
 
-    def demand_calculation_simplified(self, row):
-        try:
-            if row[self.HAS_EXISTING_DATA] == True:
-                #--
-                existing_data_df = self.address_dict[row[self.HAS_ADDRESS]]
-                heat_production = existing_data_df["Varmeproduksjon"].to_numpy()
-                power_production = existing_data_df["Strømproduksjon"].to_numpy()
-                # ml
-                grid_array = existing_data_df["Levert energi til bygg (strømmåler)"].to_numpy()
-                if int(np.sum(grid_array)) != 0:
-                    heating_related_demand, electric_related_demand = self.__predict_heating_demand(demand = grid_array, temperature = self.temperature_array)
-                    #--
-                    thermal_demand_for_calculation = heating_related_demand #+ heat_production
-                    electric_demand_for_calculation = electric_related_demand
-                    electric_demand = electric_related_demand + power_production
-                    spaceheating_demand = heating_related_demand + heat_production * 0.8 # antar at 80% varmeproduksjon er relatert til romoppvarming
-                    dhw_demand = heat_production * 0.2 # antar at 20% av varmeproduksjon er relatert til tappevann
-                else:
-                    spaceheating_series = self.PROFET_DATA[f"{row[self.PROFET_BUILDINGTYPE]}_{row[self.PROFET_BUILDINGSTANDARD]}_SPACEHEATING"]
-                    spaceheating_demand = row[self.BUILDING_AREA] * np.array(spaceheating_series)
-                    dhw_demand_series = self.PROFET_DATA[f"{row[self.PROFET_BUILDINGTYPE]}_{row[self.PROFET_BUILDINGSTANDARD]}_DHW"]
-                    dhw_demand = row[self.BUILDING_AREA] * np.array(dhw_demand_series)
-                    electric_demand_series = self.PROFET_DATA[f"{row[self.PROFET_BUILDINGTYPE]}_{row[self.PROFET_BUILDINGSTANDARD]}_ELECTRIC"]
-                    electric_demand = row[self.BUILDING_AREA] * np.array(electric_demand_series)
-                    #--
-                    thermal_demand_for_calculation = dhw_demand + spaceheating_demand - heat_production # trekke fra varmeproduksjon
-                    electric_demand_for_calculation = electric_demand - power_production # trekke fra strømproduksjon
-            else:
-                spaceheating_series = self.PROFET_DATA[f"{row[self.PROFET_BUILDINGTYPE]}_{row[self.PROFET_BUILDINGSTANDARD]}_SPACEHEATING"]
-                spaceheating_demand = row[self.BUILDING_AREA] * np.array(spaceheating_series)
-                dhw_demand_series = self.PROFET_DATA[f"{row[self.PROFET_BUILDINGTYPE]}_{row[self.PROFET_BUILDINGSTANDARD]}_DHW"]
-                dhw_demand = row[self.BUILDING_AREA] * np.array(dhw_demand_series)
-                electric_demand_series = self.PROFET_DATA[f"{row[self.PROFET_BUILDINGTYPE]}_{row[self.PROFET_BUILDINGSTANDARD]}_ELECTRIC"]
-                electric_demand = row[self.BUILDING_AREA] * np.array(electric_demand_series)
-                #--
-                thermal_demand_for_calculation = dhw_demand + spaceheating_demand
-                electric_demand_for_calculation = electric_demand
-            #--
-            thermal_demand_for_calculation = thermal_demand_for_calculation - (thermal_demand_for_calculation/100)*row[self.REDUCE_THERMAL_DEMAND]
-            electric_demand_for_calculation = electric_demand_for_calculation - (electric_demand_for_calculation/100)*row[self.REDUCE_ELECTRIC_DEMAND]
-        except Exception as e:
-            thermal_demand_for_calculation, electric_demand_for_calculation, spaceheating_demand, dhw_demand, electric_demand = [0], [0], [0], [0], [0]
-        
-        return thermal_demand_for_calculation, electric_demand_for_calculation, spaceheating_demand, dhw_demand, electric_demand
-    
-    def __dekningsgrad_calculation(self, dekningsgrad, timeserie):
+    def __profet_profiles(self, building_type, building_standard):
+        spaceheating_series = self.PROFET_DATA[f"{building_type}_{building_standard}_SPACEHEATING"].to_numpy()
+        dhw_demand_series = self.PROFET_DATA[f"{building_type}_{building_standard}_DHW"].to_numpy()
+        electric_demand_series = self.PROFET_DATA[f"{building_type}_{building_standard}_ELECTRIC"].to_numpy()
+        return spaceheating_series, dhw_demand_series, electric_demand_series
+
+    def demand_calculation_matrix(self, df):
+        # (bygg x timer)-matriser for hele tabellen, profilene hentes én gang per (bygningstype, bygningsstandard)
+        number_of_buildings, number_of_hours = len(df), len(self.PROFET_DATA)
+        spaceheating_demand = np.zeros((number_of_buildings, number_of_hours))
+        dhw_demand = np.zeros((number_of_buildings, number_of_hours))
+        electric_demand = np.zeros((number_of_buildings, number_of_hours))
+        valid = np.zeros(number_of_buildings, dtype=bool)
+        area = df[self.BUILDING_AREA].to_numpy(dtype=float)
+        for (building_type, building_standard), index in df.groupby([self.PROFET_BUILDINGTYPE, self.PROFET_BUILDINGSTANDARD], sort=False, observed=True).indices.items():
+            try:
+                spaceheating_series, dhw_demand_series, electric_demand_series = self.__profet_profiles(building_type, building_standard)
+            except KeyError:
+                continue
+            spaceheating_demand[index] = area[index, None] * spaceheating_series
+            dhw_demand[index] = area[index, None] * dhw_demand_series
+            electric_demand[index] = area[index, None] * electric_demand_series
+            valid[index] = True
+        thermal_demand_for_calculation = dhw_demand + spaceheating_demand
+        electric_demand_for_calculation = electric_demand.copy()
+        #--
+        if self.HAS_EXISTING_DATA in df.columns:
+            existing_data_index = np.flatnonzero(df[self.HAS_EXISTING_DATA].to_numpy() == True)
+            addresses = df[self.HAS_ADDRESS].to_numpy()
+            metered_index, grid_arrays, heat_productions, power_productions = [], [], [], []
+            for i in existing_data_index:
+                try:
+                    existing_data_df = self.address_dict[addresses[i]]
+                    if len(existing_data_df) != number_of_hours:
+                        valid[i] = False
+                        continue
+                    heat_production = existing_data_df["Varmeproduksjon"].to_numpy(dtype=float)
+                    power_production = existing_data_df["Strømproduksjon"].to_numpy(dtype=float)
+                    grid_array = existing_data_df["Levert energi til bygg (strømmåler)"].to_numpy(dtype=float)
+                    if int(np.sum(grid_array)) != 0:
+                        metered_index.append(i)
+                        grid_arrays.append(grid_array)
+                        heat_productions.append(heat_production)
+                        power_productions.append(power_production)
+                    else:
+                        thermal_demand_for_calculation[i] = thermal_demand_for_calculation[i] - heat_production # trekke fra varmeproduksjon
+                        electric_demand_for_calculation[i] = electric_demand_for_calculation[i] - power_production # trekke fra strømproduksjon
+                except Exception:
+                    valid[i] = False
+            if len(metered_index) > 0:
+                heat_production, power_production = np.vstack(heat_productions), np.vstack(power_productions)
+                heating_related_demand, electric_related_demand = self.predict_heating_demand_matrix(demand_matrix = np.vstack(grid_arrays), temperature = self.temperature_array)
+                thermal_demand_for_calculation[metered_index] = heating_related_demand
+                electric_demand_for_calculation[metered_index] = electric_related_demand
+                electric_demand[metered_index] = electric_related_demand + power_production
+                spaceheating_demand[metered_index] = heating_related_demand + heat_production * 0.8 # antar at 80% varmeproduksjon er relatert til romoppvarming
+                dhw_demand[metered_index] = heat_production * 0.2 # antar at 20% av varmeproduksjon er relatert til tappevann
+                valid[metered_index] = True
+        demand_matrices = {
+            self.THERMAL_DEMAND_FOR_CALCULATION : thermal_demand_for_calculation,
+            self.ELECTRIC_DEMAND_FOR_CALCULATION : electric_demand_for_calculation,
+            self.SPACEHEATING_DEMAND : spaceheating_demand,
+            self.DHW_DEMAND : dhw_demand,
+            self.ELECTRIC_DEMAND : electric_demand,
+            }
+        for matrix in demand_matrices.values():
+            matrix[~valid] = 0
+        return demand_matrices, valid
+
+    def reduction_calculation_matrix(self, df, matrices):
+        thermal_demand_for_calculation = matrices[self.THERMAL_DEMAND_FOR_CALCULATION]
+        electric_demand_for_calculation = matrices[self.ELECTRIC_DEMAND_FOR_CALCULATION]
+        thermal_demand_for_calculation -= (thermal_demand_for_calculation/100) * df[self.REDUCE_THERMAL_DEMAND].to_numpy(dtype=float)[:, None]
+        electric_demand_for_calculation -= (electric_demand_for_calculation/100) * df[self.REDUCE_ELECTRIC_DEMAND].to_numpy(dtype=float)[:, None]
+        return matrices
+
+    def dekningsgrad_calculation_matrix(self, dekningsgrad, timeserie_matrix):
+        # eksakt kuttverdi per bygg fra sortert serie og kumulativ sum, samme dekningsgrad for alle rader
+        timeserie_matrix = np.atleast_2d(timeserie_matrix)
+        timeserie_sum = np.sum(timeserie_matrix, axis=1)
         if dekningsgrad == 100:
-            return timeserie
-        timeserie_sortert = np.sort(timeserie)
-        timeserie_sum = np.sum(timeserie)
-        timeserie_N = len(timeserie)
-        startpunkt = timeserie_N // 2
-        i = 0
-        avvik = 0.0001
-        pm = 2 + avvik
-        while abs(pm - 1) > avvik:
-            cutoff = timeserie_sortert[startpunkt]
-            timeserie_tmp = np.where(timeserie > cutoff, cutoff, timeserie)
-            beregnet_dekningsgrad = (np.sum(timeserie_tmp) / timeserie_sum) * 100
-            pm = beregnet_dekningsgrad / dekningsgrad
-            gammelt_startpunkt = startpunkt
-            if pm < 1:
-                startpunkt = startpunkt + timeserie_N // 2 ** (i + 2) - 1
-            else:
-                startpunkt = startpunkt - timeserie_N // 2 ** (i + 2) - 1
-            if startpunkt == gammelt_startpunkt:
-                break
-            i += 1
-            if i > 13:
-                break
-        return timeserie_tmp
-    
-    def varmepumpe_calculation(self, row):
+            return timeserie_matrix, np.full(len(timeserie_matrix), 100.0)
+        timeserie_sortert = np.sort(timeserie_matrix, axis=1)
+        timeserie_N = timeserie_sortert.shape[1]
+        timeserie_kumulativ = np.cumsum(timeserie_sortert, axis=1)
+        # dekket energi når kuttverdien settes lik den k-te sorterte verdien
+        dekket = timeserie_kumulativ + timeserie_sortert * (timeserie_N - 1 - np.arange(timeserie_N))
+        maal = timeserie_sum * dekningsgrad / 100
+        k = np.minimum(np.sum(dekket < maal[:, None], axis=1), timeserie_N - 1)
+        under_kutt = np.where(k > 0, np.take_along_axis(timeserie_kumulativ, np.maximum(k - 1, 0)[:, None], axis=1)[:, 0], 0)
+        cutoff = (maal - under_kutt) / (timeserie_N - k)
+        timeserie_tmp = np.minimum(timeserie_matrix, cutoff[:, None])
+        beregnet_dekningsgrad = np.full(len(timeserie_matrix), 100.0)
+        np.divide(np.sum(timeserie_tmp, axis=1) * 100, timeserie_sum, out=beregnet_dekningsgrad, where=timeserie_sum != 0)
+        return timeserie_tmp, beregnet_dekningsgrad
+
+    def luft_luft_varmepumpe_calculation_matrix(self, varmebehov, p_hp_table, cop_hp_table, interpolate_hp_table, temperature):
+        # varmebehov er (bygg x timer), tabellene er (timer x 3) for full, halv og minste last
+        P_NOMINAL = np.minimum(np.max(varmebehov, axis=1) * 0.4, 10) # 40% effektdekningsgrad, ikke større varmepumpe enn 10 kW?
+        p_hp_max = P_NOMINAL[:, None] * p_hp_table[:, 0]
+        p_hp_min = P_NOMINAL[:, None] * p_hp_table[:, 2]
+        full_last = varmebehov >= p_hp_max
+        lav_last = ~full_last & (varmebehov <= p_hp_min)
+        for_kaldt = np.asarray(temperature) < -15
+        varmepumpe = np.where(full_last, p_hp_max, varmebehov)
+        cop = np.where(full_last, cop_hp_table[:, 0], np.where(lav_last, cop_hp_table[:, 2], interpolate_hp_table))
+        varmepumpe[:, for_kaldt] = 0
+        cop[:, for_kaldt] = 1
+        levert_fra_kilde = varmepumpe - varmepumpe / cop
+        kompressor = varmepumpe - levert_fra_kilde
+        spisslast = varmebehov - varmepumpe
+        return kompressor, levert_fra_kilde, spisslast, cop
+
+    def varmepumpe_calculation_matrix(self, df, thermal_demand):
         VIRKNINGSGRAD = 1
-        kompressor, levert_fra_kilde, spisslast = 0, 0, 0
-        try:
-            if (row[self.GSHP] == 1) | (row[self.ASHP] == 1):
-                varmebehov = row[self.THERMAL_DEMAND_FOR_CALCULATION] * VIRKNINGSGRAD
-                if row[self.GSHP] == 1:
-                    levert_fra_varmepumpe = self.__dekningsgrad_calculation(self.DEKNINGSGRADER_GSHP[row[self.PROFET_BUILDINGTYPE]], varmebehov * VIRKNINGSGRAD)
-                    levert_fra_kilde = levert_fra_varmepumpe - (levert_fra_varmepumpe/self.COEFFICIENT_OF_PERFORMANCES_GSHP[row[self.PROFET_BUILDINGTYPE]])
-                    kompressor = levert_fra_varmepumpe - levert_fra_kilde
-                    levert_fra_kilde = levert_fra_varmepumpe - kompressor
-                    spisslast = varmebehov - levert_fra_varmepumpe
-                else:
-                    temperature = self.temperature_array # kan utbedres
-                    varmepumpe = np.zeros(8760)
-                    cop = np.zeros(8760)
-                    P_NOMINAL = np.max(varmebehov) * 0.4 # 40% effektdekningsgrad
-                    if P_NOMINAL > 10: # ikke større varmepumpe enn 10 kW?
-                        P_NOMINAL = 10
-                    for i, outdoor_temperature in enumerate(temperature):
-                        effekt = varmebehov[i]
-                        if outdoor_temperature < -15:
-                            cop[i] = 1
-                            varmepumpe[i] = 0
-                        else:
-                            varmepumpe_effekt_verdi = effekt
-                            p_hp_list = self.P_HP_DICT[i] * P_NOMINAL
-                            cop_hp_list = self.COP_HP_DICT[i]
-                            if effekt >= p_hp_list[0]:
-                                varmepumpe_effekt_verdi = p_hp_list[0]
-                                cop_verdi = cop_hp_list[0]
-                            elif effekt <= p_hp_list[2]:
-                                cop_verdi = cop_hp_list[2]
-                            else:
-                                cop_verdi = self.INTERPOLATE_HP_DICT[i]
-                            varmepumpe[i] = varmepumpe_effekt_verdi
-                            cop[i] = cop_verdi
-                    levert_fra_kilde = varmepumpe - varmepumpe / np.array(cop_verdi)
-                    kompressor = varmepumpe - levert_fra_kilde
-                    spisslast = varmebehov - varmepumpe
-        except Exception:
-            pass
-            #logger.info('Varmepumpeberegning feilet')
+        varmebehov = thermal_demand * VIRKNINGSGRAD
+        kompressor, levert_fra_kilde, spisslast = np.zeros_like(varmebehov), np.zeros_like(varmebehov), np.zeros_like(varmebehov)
+        building_types = df[self.PROFET_BUILDINGTYPE].astype(object)
+        dekningsgrader = building_types.map(self.DEKNINGSGRADER_GSHP).to_numpy(dtype=float)
+        cop_gshp = building_types.map(self.COEFFICIENT_OF_PERFORMANCES_GSHP).to_numpy(dtype=float)
+        gshp = (df[self.GSHP].to_numpy() == 1)
+        ashp = (df[self.ASHP].to_numpy() == 1) & ~gshp
+        gshp = gshp & ~np.isnan(dekningsgrader)
+        for dekningsgrad in np.unique(dekningsgrader[gshp]):
+            index = np.flatnonzero(gshp & (dekningsgrader == dekningsgrad))
+            levert_fra_varmepumpe, _ = self.dekningsgrad_calculation_matrix(dekningsgrad, varmebehov[index] * VIRKNINGSGRAD)
+            kompressor[index] = levert_fra_varmepumpe / cop_gshp[index, None]
+            levert_fra_kilde[index] = levert_fra_varmepumpe - kompressor[index]
+            spisslast[index] = varmebehov[index] - levert_fra_varmepumpe
+        if np.any(ashp):
+            index = np.flatnonzero(ashp)
+            kompressor[index], levert_fra_kilde[index], spisslast[index], _ = self.luft_luft_varmepumpe_calculation_matrix(varmebehov[index], self.P_HP_TABLE, self.COP_HP_TABLE, self.INTERPOLATE_HP_TABLE, self.temperature_array)
         return kompressor, -levert_fra_kilde, spisslast
 
-    def fjernvarme_calculation(self, row):
+    def fjernvarme_calculation_matrix(self, df, thermal_demand):
         VIRKNINGSGRAD = 1
         DEKNINGSGRAD = 100
-        fjernvarme = 0
-        try:
-            if row[self.DISTRICT_HEATING] == 1:
-                fjernvarme = self.__dekningsgrad_calculation(DEKNINGSGRAD, row[self.THERMAL_DEMAND_FOR_CALCULATION] * VIRKNINGSGRAD)
-        except Exception:
-            pass
-            #logger.info("Fjernvarmeberegning feilet")
+        fjernvarme = np.zeros_like(thermal_demand)
+        index = np.flatnonzero(df[self.DISTRICT_HEATING].to_numpy() == 1)
+        if len(index) > 0:
+            fjernvarme[index], _ = self.dekningsgrad_calculation_matrix(DEKNINGSGRAD, thermal_demand[index] * VIRKNINGSGRAD)
         return -fjernvarme
 
-    def solcelle_calculation(self, row):
-        solceller = 0
-        try:
-            if row[self.BUILDING_AREA] != 0:
-                area = row[self.BEBYGD_AREA]
-                if area == 0:
-                    try:
-                        number_of_floors = row[self.STORIES]
-                        scale_factor = number_of_floors
-                    except:
-                        scale_factor = 5
-                    area = row[self.BUILDING_AREA] / scale_factor
-                if row[self.SOLAR_PANELS] == 1:
-                    solceller = area * self.SOLARPANEL_DATA[self.SOLARPANEL_BUILDINGS[row[self.PROFET_BUILDINGTYPE]]].to_numpy()
-        except Exception:
-            pass
-            #logger.info("Solcelleberegning feilet")
-        return -solceller
-    
-    def grunnvarme_meter_and_cost_calculation(self, row):
-        well_meter, gshp_cost = 0, 0
-        try:
-            if row[self.GSHP] == True:
-                cost_per_well_meter = 600
-                well_meter = round(np.sum(abs(row[self.FROM_SOURCE])) / 80,0)
-                gshp_cost = round(well_meter * cost_per_well_meter,0)
-        except Exception:
-            pass
-            #logger.info("Kostnadsberegning grunnvarme feilet")
-        return well_meter, gshp_cost
-        
-    def compile_data(self, row):
-        if (len(row[self.THERMAL_DEMAND_FOR_CALCULATION]) == 1) or (len(row[self.ELECTRIC_DEMAND_FOR_CALCULATION]) == 1):
-            total_balance, year_sum, winter_max, summer_max = 0, 0, 0, 0 
-        else:
-            thermal_balance = row[self.THERMAL_DEMAND_FOR_CALCULATION] + row[self.FROM_SOURCE] - row[self.COMPRESSOR] - row[self.PEAK] + row[self.DISTRICT_HEATING_PRODUCED]
-            electric_balance = row[self.ELECTRIC_DEMAND_FOR_CALCULATION] + row[self.COMPRESSOR] + row[self.PEAK] + row[self.SOLAR_PANELS_PRODUCED]
-            total_balance = thermal_balance + electric_balance
-            year_sum = round(np.sum(total_balance),-2)
-            winter_max = round((total_balance[self.WINTER_MAX]),0)
-            summer_max = round((total_balance[self.SUMMER_MAX]),0)
-        return total_balance, self.__rounding_energy(year_sum), self.__rounding_effect(winter_max), self.__rounding_effect(summer_max)
-    
-    def sumify(self, row):
-        thermal_demand = self.__rounding_energy(np.sum(row[self.THERMAL_DEMAND_FOR_CALCULATION]))
-        from_source = self.__rounding_energy(np.sum(row[self.FROM_SOURCE]))
-        district_heating_produced = self.__rounding_energy(np.sum(row[self.DISTRICT_HEATING_PRODUCED]))
-        electric_demand = self.__rounding_energy(np.sum(row[self.ELECTRIC_DEMAND_FOR_CALCULATION]))
-        compressor = self.__rounding_energy(np.sum(row[self.COMPRESSOR]))
-        peak = self.__rounding_energy(np.sum(row[self.PEAK]))
-        solar_panels_produced = self.__rounding_energy(np.sum(row[self.SOLAR_PANELS_PRODUCED]))
-        return abs(thermal_demand), abs(from_source), abs(district_heating_produced), abs(electric_demand), abs(compressor), abs(peak), abs(solar_panels_produced)
-    
-    def maxify_winter(self, row):
-        max_index = self.WINTER_MAX
-        try:
-            thermal_demand = self.__rounding_effect((row[self.THERMAL_DEMAND_FOR_CALCULATION])[max_index])
-        except Exception:
-            thermal_demand = 0
-        try:
-            from_source = self.__rounding_effect((row[self.FROM_SOURCE])[max_index])
-        except Exception:
-            from_source = 0
-        try:
-            district_heating_produced = self.__rounding_effect((row[self.DISTRICT_HEATING_PRODUCED])[max_index])
-        except Exception:
-            district_heating_produced = 0
-        try:
-            electric_demand = self.__rounding_effect((row[self.ELECTRIC_DEMAND_FOR_CALCULATION])[max_index])
-        except Exception:
-            electric_demand = 0
-        try:
-            compressor = self.__rounding_effect((row[self.COMPRESSOR])[max_index])
-        except Exception:
-            compressor = 0
-        try:
-            peak = self.__rounding_effect((row[self.PEAK])[max_index])
-        except Exception:
-            peak = 0
-        try:
-            solar_panels_produced = self.__rounding_effect((row[self.SOLAR_PANELS_PRODUCED])[max_index])
-        except Exception:
-            solar_panels_produced = 0
-        return abs(thermal_demand), abs(from_source), abs(district_heating_produced), abs(electric_demand), abs(compressor), abs(peak), abs(solar_panels_produced)     
-    
-    def maxify_summer(self, row):
-        max_index = self.SUMMER_MAX
-        try:
-            thermal_demand = self.__rounding_effect((row[self.THERMAL_DEMAND_FOR_CALCULATION])[max_index])
-        except Exception:
-            thermal_demand = 0
-        try:
-            from_source = self.__rounding_effect((row[self.FROM_SOURCE])[max_index])
-        except Exception:
-            from_source = 0
-        try:
-            district_heating_produced = self.__rounding_effect((row[self.DISTRICT_HEATING_PRODUCED])[max_index])
-        except Exception:
-            district_heating_produced = 0
-        try:
-            electric_demand = self.__rounding_effect((row[self.ELECTRIC_DEMAND_FOR_CALCULATION])[max_index])
-        except Exception:
-            electric_demand = 0
-        try:
-            compressor = self.__rounding_effect((row[self.COMPRESSOR])[max_index])
-        except Exception:
-            compressor = 0
-        try:
-            peak = self.__rounding_effect((row[self.PEAK])[max_index])
-        except Exception:
-            peak = 0
-        try:
-            solar_panels_produced = self.__rounding_effect((row[self.SOLAR_PANELS_PRODUCED])[max_index])
-        except Exception:
-            solar_panels_produced = 0
-        return abs(thermal_demand), abs(from_source), abs(district_heating_produced), abs(electric_demand), abs(compressor), abs(peak), abs(solar_panels_produced) 
+    def solcelle_calculation_matrix(self, df):
+        solceller = np.zeros((len(df), len(self.SOLARPANEL_DATA)))
+        building_area = df[self.BUILDING_AREA].to_numpy(dtype=float)
+        number_of_floors = df[self.STORIES].to_numpy(dtype=float)
+        area = df[self.BEBYGD_AREA].to_numpy(dtype=float)
+        # uten bebygd areal og uten antall etasjer finnes ingen takflate; som før gir det ingen solceller, men bygget flagges
+        missing_roof = (area == 0) & ~(number_of_floors > 0)
+        area = np.where(area == 0, building_area / np.where(missing_roof, 1, number_of_floors), area)
+        selected = (building_area != 0) & (df[self.SOLAR_PANELS].to_numpy() == 1)
+        valid = ~(selected & missing_roof)
+        selected = selected & valid
+        solarpanel_buildings = df[self.PROFET_BUILDINGTYPE].astype(object).map(self.SOLARPANEL_BUILDINGS).to_numpy()
+        for solarpanel_building in pd.unique(solarpanel_buildings[selected]):
+            if not isinstance(solarpanel_building, str):
+                continue
+            index = np.flatnonzero(selected & (solarpanel_buildings == solarpanel_building))
+            solceller[index] = area[index, None] * self.SOLARPANEL_DATA[solarpanel_building].to_numpy()
+        return -solceller, valid
+
+    def kpi_calculation_matrix(self, df, matrices, valid):
+        # nettbalanse, årssummer og verdier i WINTER_MAX/SUMMER_MAX for alle komponenter i ett sveip
+        cost_per_well_meter = 600
+        well_meter = np.where(df[self.GSHP].to_numpy() == True, np.round(np.sum(np.abs(matrices[self.FROM_SOURCE]), axis=1) / 80, 0), 0)
+        df[f"{self.GSHP}_meter"] = well_meter
+        df[f"{self.GSHP}_kostnad"] = np.round(well_meter * cost_per_well_meter, 0)
+        #--
+        thermal_balance = matrices[self.THERMAL_DEMAND_FOR_CALCULATION] + matrices[self.FROM_SOURCE] - matrices[self.COMPRESSOR] - matrices[self.PEAK] + matrices[self.DISTRICT_HEATING_PRODUCED]
+        electric_balance = matrices[self.ELECTRIC_DEMAND_FOR_CALCULATION] + matrices[self.COMPRESSOR] + matrices[self.PEAK] + matrices[self.SOLAR_PANELS_PRODUCED]
+        total_balance = thermal_balance + electric_balance
+        total_balance[~valid] = 0
+        matrices[f'{self.GRID}_energi_liste'] = total_balance
+        df[f'{self.GRID}_energi'] = self.__rounding_energy(np.round(np.sum(total_balance, axis=1), -2))
+        df[f'{self.GRID}_vintereffekt'] = self.__rounding_effect(np.round(total_balance[:, self.WINTER_MAX], 0))
+        df[f'{self.GRID}_sommereffekt'] = self.__rounding_effect(np.round(total_balance[:, self.SUMMER_MAX], 0))
+        #--
+        components = [self.THERMAL_DEMAND_FOR_CALCULATION, self.FROM_SOURCE, self.DISTRICT_HEATING_PRODUCED, self.ELECTRIC_DEMAND_FOR_CALCULATION, self.COMPRESSOR, self.PEAK, self.SOLAR_PANELS_PRODUCED]
+        for component in components:
+            df[f'{component}_sum'] = np.abs(self.__rounding_energy(np.sum(matrices[component], axis=1)))
+        for component in components:
+            df[f'{component}_vintereffekt'] = np.abs(self.__rounding_effect(matrices[component][:, self.WINTER_MAX]))
+        for component in components:
+            df[f'{component}_sommereffekt'] = np.abs(self.__rounding_effect(matrices[component][:, self.SUMMER_MAX]))
+        return df
     
-    def run_simulation(self, df, scenario_name, chunk_size = 1000, test = True):
+    def __write_hourly_parquet(self, file_path, object_ids, hourly_matrices, scenario_name):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        number_of_hours = hourly_matrices[self.HOURLY_DATA_FIELDS[0]].shape[1]
+        value_type = pa.from_numpy_dtype(hourly_matrices[self.HOURLY_DATA_FIELDS[0]].dtype)
+        schema = pa.schema([pa.field(object_id, value_type) for object_id in object_ids] + [pa.field("ID", pa.string()), pa.field("scenario", pa.string())])
+        with pq.ParquetWriter(file_path, schema) as writer:
+            for datafield in self.HOURLY_DATA_FIELDS:
+                matrix = hourly_matrices[datafield]
+                columns = [pa.array(matrix[i], type=value_type) for i in range(len(matrix))]
+                columns += [pa.array(np.repeat(datafield, number_of_hours)), pa.array(np.repeat(scenario_name, number_of_hours))]
+                writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+    def __remove_hourly_data(self, scenario_name):
+        # gamle timedata i et annet format skal ikke leses av kartapplikasjonen
+        shutil.rmtree(f"output/{scenario_name}_timedata", ignore_errors=True)
+        for file_path in [f"output/{scenario_name}_timedata.parquet", f"output/{scenario_name}_timedata.csv"]:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def export_hourly_data(self, object_ids, hourly_matrices, scenario_name):
+        # én kolonne per bygg, ett radsett (8760 timer) per datafelt
+        object_ids = [f"{object_id}" for object_id in object_ids]
+        number_of_hours = hourly_matrices[self.HOURLY_DATA_FIELDS[0]].shape[1]
+        self.__remove_hourly_data(scenario_name)
+        if self.HOURLY_DATA_FORMAT == "csv":
+            df = pd.DataFrame(np.concatenate([hourly_matrices[datafield].T for datafield in self.HOURLY_DATA_FIELDS]), columns=object_ids)
+            df["ID"] = np.repeat(self.HOURLY_DATA_FIELDS, number_of_hours)
+            df["scenario"] = scenario_name
+            df.to_csv(f"output/{scenario_name}_timedata.csv")
+            return
+        self.__write_hourly_parquet(f"output/{scenario_name}_timedata.parquet", object_ids, hourly_matrices, scenario_name)
+
+    def read_hourly_parts(self, parts_folder, object_ids):
+        # {datafelt: (bygg, timer)} for object_ids, leser kun kolonnene for byggene fra delene som har dem
+        with open(f"{parts_folder}/manifest.json", encoding="utf-8") as file:
+            manifest = json.load(file)
+        object_ids = [f"{object_id}" for object_id in object_ids]
+        selected = set(object_ids)
+        frames = []
+        for part in manifest["parts"]:
+            columns = [object_id for object_id in part["ids"] if object_id in selected]
+            if len(columns) > 0:
+                frames.append(pd.read_parquet(f"{parts_folder}/{part['file']}", columns=columns))
+        values = pd.concat(frames, axis=1)[object_ids].to_numpy(dtype=self.DTYPE) if len(frames) > 0 else np.empty((len(manifest["fields"]) * manifest["hours"], 0), dtype=self.DTYPE)
+        number_of_hours = manifest["hours"]
+        return {datafield: values[i*number_of_hours:(i+1)*number_of_hours].T for i, datafield in enumerate(manifest["fields"])}
+
+    def __split_unchanged_buildings(self, df, reference_df):
+        reference_index = pd.Index(reference_df[self.OBJECT_ID])
+        position = reference_index.get_indexer(df[self.OBJECT_ID])
+        found = position >= 0
+        signature = df[self.SIMULATION_SIGNATURE].to_numpy(dtype=object)
+        reference_signature = reference_df[self.SIMULATION_SIGNATURE].to_numpy(dtype=object)[position[found]]
+        unchanged = np.zeros(len(df), dtype=bool)
+        unchanged[found] = (signature[found] == reference_signature).all(axis=1)
+        reused_position = position[unchanged]
+        reused_df = reference_df.iloc[reused_position]
+        return df[~unchanged], reused_df, reused_position
+
+    def __reference_hourly_rows(self, reference_hourly_matrices, reused_df, reused_position):
+        if isinstance(reference_hourly_matrices, str):
+            # strømmet referanse: timeverdiene ligger i delene på disk
+            return self.read_hourly_parts(reference_hourly_matrices, reused_df[self.OBJECT_ID])
+        return {datafield: np.asarray(reference_hourly_matrices[datafield][reused_position]) for datafield in self.HOURLY_DATA_FIELDS}
+
+    def __simulate_chunk(self, df_chunked, chunk):
+        rows = len(df_chunked)
+        # demand
+        with self.run_report.stage("demand", rows = rows, chunk = chunk) as stage:
+            matrices, valid = self.demand_calculation_matrix(df_chunked)
+            stage["invalid"] = int(np.count_nonzero(~valid))
+        with self.run_report.stage("reductions", rows = rows, chunk = chunk):
+            matrices = self.reduction_calculation_matrix(df_chunked, matrices)
+        # supply
+        with self.run_report.stage("heat_pump", rows = rows, chunk = chunk):
+            matrices[self.COMPRESSOR], matrices[self.FROM_SOURCE], matrices[self.PEAK] = self.varmepumpe_calculation_matrix(df_chunked, matrices[self.THERMAL_DEMAND_FOR_CALCULATION])
+        with self.run_report.stage("district_heating", rows = rows, chunk = chunk):
+            matrices[self.DISTRICT_HEATING_PRODUCED] = self.fjernvarme_calculation_matrix(df_chunked, matrices[self.THERMAL_DEMAND_FOR_CALCULATION])
+        with self.run_report.stage("solar", rows = rows, chunk = chunk) as stage:
+            matrices[self.SOLAR_PANELS_PRODUCED], solar_valid = self.solcelle_calculation_matrix(df_chunked)
+            stage["invalid"] = int(np.count_nonzero(~solar_valid))
+        # costs and conclusion (i float64, før eventuell nedkonvertering)
+        with self.run_report.stage("kpi", rows = rows, chunk = chunk):
+            df_chunked = self.kpi_calculation_matrix(df_chunked, matrices, valid)
+        return df_chunked, {datafield: matrices[datafield].astype(self.DTYPE, copy=False) for datafield in self.HOURLY_DATA_FIELDS}
+
+    def __simulate_streaming(self, df, scenario_name, chunk_size, test, reference_result):
+        # hver chunk simuleres og skrives til output/<scenario>_timedata/part-XXXXX.parquet før neste starter;
+        # kun sammendraget (KPI-ene) holdes i minnet og sorteres på objectid til slutt
+        if test == True:
+            df = df[:3*chunk_size] # testmodus: kun de tre første chunkene
+        self.__remove_hourly_data(scenario_name)
+        parts_folder = f"output/{scenario_name}_timedata"
+        os.makedirs(parts_folder)
+        df_chunked_list, parts = [], []
+        def __write_part(df_chunked, hourly_chunked):
+            object_ids = [f"{object_id}" for object_id in df_chunked[self.OBJECT_ID]]
+            file_name = f"part-{len(parts):05d}.parquet"
+            with self.run_report.stage("export", rows = len(object_ids), chunk = len(parts)):
+                self.__write_hourly_parquet(f"{parts_folder}/{file_name}", object_ids, hourly_chunked, scenario_name)
+            parts.append({"file": file_name, "ids": object_ids})
+            df_chunked_list.append(df_chunked)
+        if reference_result is not None:
+            # uendrede bygg hentes fra referansesituasjonen chunk for chunk
+            reference_df, reference_hourly_matrices = reference_result
+            df, reused_df, reused_position = self.__split_unchanged_buildings(df, reference_df)
+            for i in range(0, len(reused_df), chunk_size):
+                with self.run_report.stage("reference_reuse", rows = len(reused_df[i:i+chunk_size]), chunk = len(parts)):
+                    reused_hourly = self.__reference_hourly_rows(reference_hourly_matrices, reused_df[i:i+chunk_size], reused_position[i:i+chunk_size])
+                __write_part(reused_df[i:i+chunk_size], reused_hourly)
+        for i in range(0, len(df), chunk_size):
+            df_chunked, hourly_chunked = self.__simulate_chunk(df[i:i+chunk_size].copy(), chunk = len(parts))
+            __write_part(df_chunked, hourly_chunked)
+            del hourly_chunked
+        manifest = {"scenario": scenario_name, "fields": self.HOURLY_DATA_FIELDS, "hours": len(self.PROFET_DATA), "parts": parts}
+        with open(f"{parts_folder}/manifest.json", "w", encoding="utf-8") as file:
+            json.dump(manifest, file, ensure_ascii=False)
+        df = pd.concat(df_chunked_list).reset_index(drop=True)
+        df = df.iloc[np.argsort(df[self.OBJECT_ID].to_numpy(), kind="stable")].reset_index(drop=True)
+        df["scenario"] = scenario_name
+        with self.run_report.stage("export", rows = len(df)):
+            df.to_csv(f"output/{scenario_name}_unfiltered.csv")
+        df[self.SCENARIO_NAME] = scenario_name
+        return df, parts_folder
+
+    def __simulate(self, df, scenario_name, chunk_size, test, reference_result):
+        if self.STREAMING == True:
+            return self.__simulate_streaming(df, scenario_name, chunk_size, test, reference_result)
+
         def __chunkify(df, chunk_size):
-            list_df = [df[i:i+chunk_size] for i in range(0,df.shape[0],chunk_size)]
+            list_df = [df[i:i+chunk_size].copy() for i in range(0,df.shape[0],chunk_size)]
             return list_df
     
-        def __merge_dataframe_list(df_chunked_list):
-            df_results = pd.concat(df_chunked_list).reset_index(drop=True)
-            df_results = df_results.sort_values(self.OBJECT_ID).reset_index(drop=True)
-            return df_results
-        
-        def __export_hourly_data(df):
-            hourly_data_fiels = [f'{self.GRID}_energi_liste', self.DHW_DEMAND, self.SPACEHEATING_DEMAND, self.ELECTRIC_DEMAND_FOR_CALCULATION, self.ELECTRIC_DEMAND, self.THERMAL_DEMAND_FOR_CALCULATION]
-            new_df = pd.DataFrame()
-            for datafield in hourly_data_fiels:
-                old_df = pd.DataFrame()
-                for count, row in df.iterrows():
-                    object_id = row[self.OBJECT_ID]
-                    array = np.zeros(8760)
-                    try:
-                        array = row[datafield].flatten()
-                    except Exception:
-                        pass
-                    old_df[f"{object_id}"] = array
-                old_df["ID"] = datafield
-                new_df = pd.concat([old_df, new_df]).reset_index(drop=True)
-            new_df["scenario"] = scenario_name
-            new_df.to_csv(f"output/{scenario_name}_timedata.csv")
-        
-        def __clean_dataframe_and_export_to_csv(df, scenario_name):
-            __export_hourly_data(df = df)
-            df["scenario"] = scenario_name
-            #df.drop([self.THERMAL_DEMAND, self.ELECTRIC_DEMAND, self.COMPRESSOR, self.FROM_SOURCE, self.PEAK, self.DISTRICT_HEATING_PRODUCED, self.SOLAR_PANELS_PRODUCED, f'_nettutveksling_energi_liste'], axis=1, inplace=True)
-            df.to_csv(f"output/{scenario_name}_unfiltered.csv")
-            #df.drop([self.THERMAL_DEMAND, self.ELECTRIC_DEMAND, self.COMPRESSOR, self.FROM_SOURCE, self.PEAK, self.DISTRICT_HEATING_PRODUCED, self.SOLAR_PANELS_PRODUCED, f'_nettutveksling_energi_liste'], axis=1, inplace=True)
+        def __clean_dataframe_and_export_to_csv(df, hourly_matrices, scenario_name):
+            with self.run_report.stage("export", rows = len(df)):
+                self.export_hourly_data(object_ids = df[self.OBJECT_ID], hourly_matrices = hourly_matrices, scenario_name = scenario_name)
+                df["scenario"] = scenario_name
+                df.to_csv(f"output/{scenario_name}_unfiltered.csv")
             df[self.SCENARIO_NAME] = scenario_name
             #df.to_csv(f"output/{scenario_name}_filtered.csv")
             return df
 
+        if test == True:
+            df = df[:3*chunk_size] # testmodus: kun de tre første chunkene
         df_chunked_list = []
+        reused_df = df.iloc[:0]
+        if reference_result is not None:
+            # kun bygg med endret signatur simuleres, resten hentes fra referansesituasjonen
+            reference_df, reference_hourly_matrices = reference_result
+            with self.run_report.stage("reference_reuse") as stage:
+                df, reused_df, reused_position = self.__split_unchanged_buildings(df, reference_df)
+                reused_hourly_matrices = self.__reference_hourly_rows(reference_hourly_matrices, reused_df, reused_position)
+                stage["rows"] = len(reused_df)
+            df_chunked_list.append(reused_df)
+        # timeverdiene skrives rett på endelig rad (sortert på objectid) i én blokk per datafelt
+        order = np.argsort(np.concatenate([reused_df[self.OBJECT_ID].to_numpy(), df[self.OBJECT_ID].to_numpy()]), kind="stable")
+        positions = np.empty(len(order), dtype=int)
+        positions[order] = np.arange(len(order))
+        hourly_matrices = {datafield: np.empty((len(order), len(self.PROFET_DATA)), dtype=self.DTYPE) for datafield in self.HOURLY_DATA_FIELDS}
+        if reference_result is not None:
+            for datafield in self.HOURLY_DATA_FIELDS:
+                hourly_matrices[datafield][positions[:len(reused_df)]] = reused_hourly_matrices[datafield]
+        offset = len(reused_df)
         chunked = __chunkify(df = df, chunk_size = chunk_size)
         for index, df_chunked in enumerate(chunked):
-            df_chunked[self.THERMAL_DEMAND_FOR_CALCULATION], df_chunked[self.ELECTRIC_DEMAND_FOR_CALCULATION], df_chunked[self.SPACEHEATING_DEMAND], df_chunked[self.DHW_DEMAND], df_chunked[self.ELECTRIC_DEMAND] = zip(*df_chunked.apply(self.demand_calculation_simplified, axis=1))
-            # supply
-            df_chunked[self.COMPRESSOR], df_chunked[self.FROM_SOURCE], df_chunked[self.PEAK] = zip(*df_chunked.apply(self.varmepumpe_calculation, axis=1))
-            df_chunked[self.DISTRICT_HEATING_PRODUCED] = df_chunked.apply(self.fjernvarme_calculation, axis=1)
-            df_chunked[self.SOLAR_PANELS_PRODUCED] = df_chunked.apply(self.solcelle_calculation, axis=1)
-            # costs
-            df_chunked[f"{self.GSHP}_meter"], df_chunked[f"{self.GSHP}_kostnad"] = zip(*df_chunked.apply(self.grunnvarme_meter_and_cost_calculation, axis=1))
-            # conclusion
-            df_chunked[f'{self.GRID}_energi_liste'], df_chunked[f'{self.GRID}_energi'], df_chunked[f'{self.GRID}_vintereffekt'], df_chunked[f'{self.GRID}_sommereffekt'] = zip(*df_chunked.apply(self.compile_data, axis=1))
-            df_chunked[f'{self.THERMAL_DEMAND_FOR_CALCULATION}_sum'], df_chunked[f'{self.FROM_SOURCE}_sum'], df_chunked[f'{self.DISTRICT_HEATING_PRODUCED}_sum'], df_chunked[f'{self.ELECTRIC_DEMAND_FOR_CALCULATION}_sum'], df_chunked[f'{self.COMPRESSOR}_sum'], df_chunked[f'{self.PEAK}_sum'], df_chunked[f'{self.SOLAR_PANELS_PRODUCED}_sum']  = zip(*df_chunked.apply(self.sumify, axis=1))   
-            df_chunked[f'{self.THERMAL_DEMAND_FOR_CALCULATION}_vintereffekt'], df_chunked[f'{self.FROM_SOURCE}_vintereffekt'], df_chunked[f'{self.DISTRICT_HEATING_PRODUCED}_vintereffekt'], df_chunked[f'{self.ELECTRIC_DEMAND_FOR_CALCULATION}_vintereffekt'], df_chunked[f'{self.COMPRESSOR}_vintereffekt'], df_chunked[f'{self.PEAK}_vintereffekt'], df_chunked[f'{self.SOLAR_PANELS_PRODUCED}_vintereffekt']  = zip(*df_chunked.apply(self.maxify_winter, axis=1))   
-            df_chunked[f'{self.THERMAL_DEMAND_FOR_CALCULATION}_sommereffekt'], df_chunked[f'{self.FROM_SOURCE}_sommereffekt'], df_chunked[f'{self.DISTRICT_HEATING_PRODUCED}_sommereffekt'], df_chunked[f'{self.ELECTRIC_DEMAND_FOR_CALCULATION}_sommereffekt'], df_chunked[f'{self.COMPRESSOR}_sommereffekt'], df_chunked[f'{self.PEAK}_sommereffekt'], df_chunked[f'{self.SOLAR_PANELS_PRODUCED}_sommereffekt']  = zip(*df_chunked.apply(self.maxify_summer, axis=1))   
+            df_chunked, hourly_chunked = self.__simulate_chunk(df_chunked, chunk = index)
             # append to
             df_chunked_list.append(df_chunked)
-            if index == 2 and test == True:
-                break 
-        df = __merge_dataframe_list(df_chunked_list)
+            for datafield in self.HOURLY_DATA_FIELDS:
+                hourly_matrices[datafield][positions[offset:offset + len(df_chunked)]] = hourly_chunked[datafield]
+            offset += len(df_chunked)
+        df = pd.concat(df_chunked_list).reset_index(drop=True)
+        df = df.iloc[order].reset_index(drop=True)
         # df logikk for å summere alt
-        df = __clean_dataframe_and_export_to_csv(df, scenario_name)
-        return df
-    
-    def add_random_values(self, df, energy_id, building_type, percentage, column):
-        fill_value = True
-        if (column == self.GSHP) or (column == self.ASHP) or (column == self.DISTRICT_HEATING):
-            unselected_df = df[~((df[self.ENERGY_AREA_ID] == energy_id) & (df[self.PROFET_BUILDINGTYPE] == building_type) & (df[self.HEATING_EXISTS] != fill_value))]
-            selected_df = df[(df[self.ENERGY_AREA_ID] == energy_id) & (df[self.PROFET_BUILDINGTYPE] == building_type) & (df[self.HEATING_EXISTS] != fill_value)]
-        else:
-            unselected_df = df[~((df[self.ENERGY_AREA_ID] == energy_id) & (df[self.PROFET_BUILDINGTYPE] == building_type))]
-            selected_df = df[(df[self.ENERGY_AREA_ID] == energy_id) & (df[self.PROFET_BUILDINGTYPE] == building_type)]
-        number_of_rows = len(selected_df)
-        n_values = int((percentage / 100) * number_of_rows)
-        random_indices = random.sample(range(number_of_rows), n_values)
-        random_values = [fill_value for _ in range(n_values)]
-        selected_df = selected_df.sort_values(self.OBJECT_ID).reset_index(drop=True)
-        selected_df.loc[random_indices, column] = random_values
-        if (column == self.GSHP) or (column == self.ASHP) or (column == self.DISTRICT_HEATING):
-            selected_df.loc[random_indices, self.HEATING_EXISTS] = random_values
-        df = pd.concat([selected_df, unselected_df], ignore_index = True)
+        df = __clean_dataframe_and_export_to_csv(df, hourly_matrices, scenario_name)
+        return df, hourly_matrices
+
+    def run_simulation(self, df, scenario_name, chunk_size = 1000, test = True, reference_result = None):
+        df, hourly_matrices = self.__simulate(df = df, scenario_name = scenario_name, chunk_size = chunk_size, test = test, reference_result = reference_result)
         return df
-    
+
     def fill_reduction_values(self, df, energy_id, building_type, percentage, column):
         unselected_df = df[~((df[self.ENERGY_AREA_ID] == energy_id) & (df[self.PROFET_BUILDINGTYPE] == building_type))]
         selected_df = df[(df[self.ENERGY_AREA_ID] == energy_id) & (df[self.PROFET_BUILDINGTYPE] == building_type)]
@@ -739,92 +924,368 @@ class EnergyAnalysis:
         df = pd.concat([selected_df, unselected_df], ignore_index = True)
         return df
     
-    def create_scenario(self, df, energy_dicts):
-        PERCENTAGE_CODE_MAP = {
-            "G" : self.GSHP,
-            "S" : self.SOLAR_PANELS,
-            "V" : self.ASHP,
-            "F" : self.DISTRICT_HEATING,
-            "O" : self.BUILDING_STANDARD_UPGRADED,
-            "T" : self.REDUCE_THERMAL_DEMAND,
-            "E" : self.REDUCE_ELECTRIC_DEMAND
-        }
-        for supply_technology in [self.GSHP, self.SOLAR_PANELS, self.ASHP, self.DISTRICT_HEATING, self.BUILDING_STANDARD_UPGRADED, self.HEATING_EXISTS]:
-            df[supply_technology] = False
-            
-        df[self.REDUCE_THERMAL_DEMAND] = 0
-        df[self.REDUCE_ELECTRIC_DEMAND] = 0
+    def __parse_percentage_codes(self, percentage_codes):
+        # "G40_V30_S20" -> [(grunnvarme, 40), (luft_luft_varmepumpe, 30), (solceller, 20)]
+        parsed_codes = {}
+        for percentage_code in percentage_codes:
+            parsed_codes[percentage_code] = [(self.PERCENTAGE_CODE_MAP[individual_percentage_code[0]], self.__string_percentage(individual_percentage_code)) for individual_percentage_code in percentage_code.split("_")]
+        return parsed_codes
+
+    def __draw_measures(self, df, energy_dicts, rng):
+        object_ids = df[self.OBJECT_ID].to_numpy()
+        measures = {tiltak: np.zeros(len(df), dtype=bool) for tiltak in [self.GSHP, self.SOLAR_PANELS, self.ASHP, self.DISTRICT_HEATING, self.BUILDING_STANDARD_UPGRADED, self.HEATING_EXISTS]}
+        measures[self.REDUCE_THERMAL_DEMAND] = np.zeros(len(df), dtype=int)
+        measures[self.REDUCE_ELECTRIC_DEMAND] = np.zeros(len(df), dtype=int)
         #--
-        unique_energy_ids = df[self.ENERGY_AREA_ID].unique()
-        for i in range(0, len(unique_energy_ids)): # energiområdeid
-            energy_id = unique_energy_ids[i]
-            #df_energy_id = df[df[self.ENERGY_AREA_ID] == energy_id]
-            percentage_codes = energy_dicts[energy_id]
-            building_types = list(percentage_codes.keys())
-            for j in range(0, len(percentage_codes)): # bygningstype i energiområde
-                building_type = building_types[j]
-                percentage_code = percentage_codes[building_type]
-                #st.write(energy_id, building_type, percentage_code)
-                individual_percentage_codes = percentage_code.split("_")
-                #st.write(individual_percentage_codes)
-                for k in range(0, len(individual_percentage_codes)):
-                    individual_percentage_code = individual_percentage_codes[k]
-                    tiltak = PERCENTAGE_CODE_MAP[individual_percentage_code[0]]
-                    tiltak_percentage = self.__string_percentage(individual_percentage_code)
-                    #st.write(tiltak, tiltak_percentage)
-                    df = self.add_random_values(df = df, energy_id = energy_id, building_type = building_type, percentage = tiltak_percentage, column = tiltak)
-                    #df = self.fill_reduction_values(df = df, energy_id = energy_id, building_type = building_type, percentage = tiltak_percentage, column = tiltak)
+        groups = df.groupby([self.ENERGY_AREA_ID, self.PROFET_BUILDINGTYPE], sort=True, observed=True).indices # fast rekkefølge, uavhengig av radrekkefølgen
+        percentage_codes = {key: energy_dicts[key[0]].get(key[1]) for key in groups}
+        parsed_codes = self.__parse_percentage_codes(set(code for code in percentage_codes.values() if code is not None))
+        for key, index in groups.items(): # energiområdeid og bygningstype
+            if percentage_codes[key] is None:
+                continue
+            index = index[np.argsort(object_ids[index], kind="stable")]
+            for tiltak, tiltak_percentage in parsed_codes[percentage_codes[key]]:
+                heating = (tiltak == self.GSHP) or (tiltak == self.ASHP) or (tiltak == self.DISTRICT_HEATING)
+                candidates = index[~measures[self.HEATING_EXISTS][index]] if heating else index
+                n_values = int((tiltak_percentage / 100) * len(candidates))
+                selected = candidates[rng.choice(len(candidates), size = n_values, replace = False)]
+                measures[tiltak][selected] = True # reduksjon settes til True, dvs. 1 %
+                if heating:
+                    measures[self.HEATING_EXISTS][selected] = True
+        return measures
+
+    def create_scenario(self, df, energy_dicts, rng = None):
+        if rng is None:
+            rng = np.random.default_rng(self.SEED)
+        df = df.copy()
+        measures = self.__draw_measures(df, energy_dicts, rng)
+        for tiltak, values in measures.items():
+            df[tiltak] = values
         #--
-        df[self.HAS_EXISTING_DATA] = False
-        for index, row in df.iterrows():
-            address = str(row[self.HAS_ADDRESS])
-            if address in self.address_keys:
-                df.at[index, self.HAS_EXISTING_DATA] = True
+        df[self.HAS_EXISTING_DATA] = df[self.HAS_ADDRESS].astype(str).isin(self.address_keys).to_numpy()
         #--
         df.loc[df[self.BUILDING_STANDARD_UPGRADED] & (df[self.PROFET_BUILDINGSTANDARD] == "Eldre"), self.PROFET_BUILDINGSTANDARD] = 'TEK10/TEK17'
         return df
     
-    def __default_simulation(self, df, energy_dicts, scenario_name):
-        start_time = time.time()
-        df = self.create_scenario(df = df, energy_dicts = energy_dicts)
-        df = self.run_simulation(df = df, scenario_name = scenario_name)
-        end_time = time.time()
-        #logger.info(f"Simulering {scenario_name}: {round((end_time - start_time),0)} sekunder")
+    def __monte_carlo_draws(self, df, energy_dicts_of_dicts, seed_sequences):
+        # trekningene stables langs en ekstra akse: {tiltak: (trekninger, bygg)}
+        realizations = self.MONTE_CARLO
+        reference_draws = [self.__draw_measures(df, energy_dicts_of_dicts[0], np.random.default_rng(seed_sequence)) for seed_sequence in seed_sequences[0].spawn(realizations)]
+        draws_per_scenario = [reference_draws]
+        for energy_dicts, scenario_seed_sequence in zip(energy_dicts_of_dicts[1:], seed_sequences[1:]):
+            draws = []
+            for reference, seed_sequence in zip(reference_draws, scenario_seed_sequence.spawn(realizations)):
+                # som modify_scenario: kun bygg uten tiltak i referansen trekkes på nytt
+                index = np.flatnonzero(~(reference[self.GSHP] | reference[self.DISTRICT_HEATING] | reference[self.ASHP] | reference[self.SOLAR_PANELS]))
+                modified = self.__draw_measures(df.iloc[index], energy_dicts, np.random.default_rng(seed_sequence))
+                draw = {tiltak: values.copy() for tiltak, values in reference.items()}
+                for tiltak, values in modified.items():
+                    draw[tiltak][index] = values
+                draw[self.BUILDING_STANDARD_UPGRADED] |= reference[self.BUILDING_STANDARD_UPGRADED] # oppgradert standard fra referansen beholdes
+                draws.append(draw)
+            draws_per_scenario.append(draws)
+        return [{tiltak: np.stack([draw[tiltak] for draw in draws]) for tiltak in draws[0]} for draws in draws_per_scenario]
+
+    def __accumulate_monte_carlo(self, totals, building_values, columns, coefficients, basis):
+        totals += coefficients @ basis
+        building_values["energi"][:, columns] += coefficients * np.sum(basis, axis=1)
+        building_values["vintereffekt"][:, columns] += coefficients * basis[:, self.WINTER_MAX]
+        building_values["sommereffekt"][:, columns] += coefficients * basis[:, self.SUMMER_MAX]
+
+    def monte_carlo_simulation(self, df, draws, scenario_name, chunk_size = 1000, test = True):
+        # nettbalansen er lineær i tiltakene gitt standard og reduksjon:
+        # nett = t*(1-F)*T + e*E + S*sol + t*G*grunnvarme(T) + V*luft_luft(t*T), summert over standard (opprinnelig/oppgradert)
+        # behovsmatrisene beregnes én gang per chunk og deles av alle trekninger
+        if test == True:
+            df = df[:3*chunk_size]
+            draws = {tiltak: values[:, :3*chunk_size] for tiltak, values in draws.items()}
+        df = df.copy()
+        df[self.HAS_EXISTING_DATA] = df[self.HAS_ADDRESS].astype(str).isin(self.address_keys).to_numpy()
+        df[self.REDUCE_THERMAL_DEMAND] = 0
+        df[self.REDUCE_ELECTRIC_DEMAND] = 0
+        upgraded_df = df.copy()
+        upgraded_df.loc[upgraded_df[self.PROFET_BUILDINGSTANDARD] == "Eldre", self.PROFET_BUILDINGSTANDARD] = 'TEK10/TEK17'
+        #--
+        realizations, number_of_buildings = draws[self.GSHP].shape
+        upgraded = draws[self.BUILDING_STANDARD_UPGRADED]
+        thermal_factor = 1 - draws[self.REDUCE_THERMAL_DEMAND] / 100
+        electric_factor = 1 - draws[self.REDUCE_ELECTRIC_DEMAND] / 100
+        dekningsgrader = df[self.PROFET_BUILDINGTYPE].astype(object).map(self.DEKNINGSGRADER_GSHP).to_numpy(dtype=float)
+        gshp = (draws[self.GSHP] == 1) & ~np.isnan(dekningsgrader)[None, :]
+        ashp = (draws[self.ASHP] == 1) & ~(draws[self.GSHP] == 1)
+        district_heating = draws[self.DISTRICT_HEATING] == 1
+        solar = draws[self.SOLAR_PANELS] == 1
+        totals = np.zeros((realizations, len(self.temperature_array)))
+        building_values = {stat: np.zeros((realizations, number_of_buildings)) for stat in ["energi", "vintereffekt", "sommereffekt"]}
+        for start in range(0, number_of_buildings, chunk_size):
+            columns = np.arange(start, min(start + chunk_size, number_of_buildings))
+            solar_coefficients = np.zeros((realizations, len(columns)))
+            for standard, variant_df in enumerate([df, upgraded_df]):
+                chunk = variant_df.iloc[columns]
+                matrices, valid = self.demand_calculation_matrix(chunk)
+                thermal = matrices[self.THERMAL_DEMAND_FOR_CALCULATION]
+                selected = (upgraded[:, columns] == standard) & valid[None, :]
+                t = thermal_factor[:, columns]
+                self.__accumulate_monte_carlo(totals, building_values, columns, selected * t * ~district_heating[:, columns], thermal)
+                self.__accumulate_monte_carlo(totals, building_values, columns, selected * electric_factor[:, columns], matrices[self.ELECTRIC_DEMAND_FOR_CALCULATION])
+                solar_coefficients += selected * solar[:, columns]
+                # grunnvarme skalerer lineært med reduksjonen (dekningsgraden gir samme andel)
+                # bare levert fra kilde inngår i basisen: kompressor og spisslast trekkes fra termisk og legges til elektrisk, og går mot hverandre i nettbalansen
+                rows = np.flatnonzero(np.any(gshp[:, columns], axis=0))
+                if len(rows) > 0:
+                    _, levert_fra_kilde, _ = self.varmepumpe_calculation_matrix(chunk.iloc[rows].assign(**{self.GSHP: True, self.ASHP: False}), thermal[rows])
+                    self.__accumulate_monte_carlo(totals, building_values, columns[rows], (selected * t * gshp[:, columns])[:, rows], levert_fra_kilde)
+                # luft-luft er ikke lineær, beregnes for hver reduksjonsfaktor som forekommer
+                rows = np.flatnonzero(np.any(ashp[:, columns], axis=0))
+                for factor in np.unique(t[:, rows]):
+                    _, levert_fra_kilde, _ = self.varmepumpe_calculation_matrix(chunk.iloc[rows].assign(**{self.GSHP: False, self.ASHP: True}), factor * thermal[rows])
+                    self.__accumulate_monte_carlo(totals, building_values, columns[rows], (selected * ashp[:, columns] * (t == factor))[:, rows], levert_fra_kilde)
+            solar_matrix, _ = self.solcelle_calculation_matrix(df.iloc[columns].assign(**{self.SOLAR_PANELS: True}))
+            self.__accumulate_monte_carlo(totals, building_values, columns, solar_coefficients, solar_matrix)
+        #--
+        percentiles = self.MONTE_CARLO_PERCENTILES
+        result_df = pd.DataFrame({self.OBJECT_ID: df[self.OBJECT_ID].to_numpy()})
+        for stat, values in building_values.items():
+            for percentile, percentile_values in zip(percentiles, np.percentile(values, percentiles, axis=0)):
+                result_df[f"{self.GRID}_{stat}_p{percentile}"] = percentile_values
+        result_df = result_df.sort_values(self.OBJECT_ID, kind="stable").reset_index(drop=True)
+        result_df["scenario"] = scenario_name
+        result_df.to_csv(f"output/{scenario_name}_montecarlo.csv")
+        total_df = pd.DataFrame({
+            "persentil": percentiles,
+            f"{self.GRID}_energi": np.percentile(np.sum(totals, axis=1), percentiles),
+            f"{self.GRID}_vintereffekt": np.percentile(totals[:, self.WINTER_MAX], percentiles),
+            f"{self.GRID}_sommereffekt": np.percentile(totals[:, self.SUMMER_MAX], percentiles),
+            f"{self.GRID}_makseffekt": np.percentile(np.max(totals, axis=1), percentiles)
+            })
+        total_df["scenario"] = scenario_name
+        total_df.to_csv(f"output/{scenario_name}_montecarlo_total.csv")
+        return result_df, total_df
+
+    def __default_simulation(self, df, energy_dicts, scenario_name, rng):
+        with self.run_report.stage("scenario", rows = len(df), scenario = scenario_name):
+            with self.run_report.stage("create_scenario", rows = len(df)):
+                df = self.create_scenario(df = df, energy_dicts = energy_dicts, rng = rng)
+            df, hourly_matrices = self.__simulate(df = df, scenario_name = scenario_name, chunk_size = 1000, test = True, reference_result = None)
+        if self.INCREMENTAL == True:
+            self.reference_result = (df, hourly_matrices)
         #self.export_to_arcgis(df = df, gdb = gdb, scenario_name = scenario_name)   
         #logger.info(f"Eksportert til ArcGIS")
         return df
     
-    def __modified_simulation(self, df, energy_dicts, scenario_name):
-        start_time = time.time()
-        df = self.modify_scenario(df = df, energy_dicts = energy_dicts)
-        df = self.run_simulation(df = df, scenario_name = scenario_name)
-        end_time = time.time()
-        #logger.info(f"Simulering {scenario_name}: {round((end_time - start_time),0)} sekunder")
+    def __modified_simulation(self, df, energy_dicts, scenario_name, rng):
+        with self.run_report.stage("scenario", rows = len(df), scenario = scenario_name):
+            with self.run_report.stage("create_scenario", rows = len(df)):
+                df = self.modify_scenario(df = df, energy_dicts = energy_dicts, rng = rng)
+            df = self.run_simulation(df = df, scenario_name = scenario_name, reference_result = self.reference_result)
         #self.export_to_arcgis(df = df, gdb = gdb, scenario_name = scenario_name)  
         #logger.info(f"Eksportert til ArcGIS")
     
+    def __share_inputs(self, shared_memory_blocks):
+        # read-only input legges i delt minne en gang, ikke pickles per scenario
+        ashp_table = np.vstack([self.P_HP_TABLE.T, self.COP_HP_TABLE.T, self.INTERPOLATE_HP_TABLE])
+        shared_arrays = {
+            "PROFET_DATA": _share_array(self.PROFET_DATA.to_numpy(dtype=float), shared_memory_blocks),
+            "SOLARPANEL_DATA": _share_array(self.SOLARPANEL_DATA.to_numpy(dtype=float), shared_memory_blocks),
+            "temperature_array": _share_array(np.asarray(self.temperature_array, dtype=float), shared_memory_blocks),
+            "ASHP_TABLE": _share_array(ashp_table, shared_memory_blocks)
+            }
+        reference_result = None
+        if self.reference_result is not None:
+            reference_df, reference_hourly_matrices = self.reference_result
+            if isinstance(reference_hourly_matrices, str):
+                reference_result = self.reference_result # strømmet: prosessene leser delene fra disk
+            else:
+                reference_result = (reference_df, {datafield: _share_array(reference_hourly_matrices[datafield], shared_memory_blocks) for datafield in self.HOURLY_DATA_FIELDS})
+        worker_state = {
+            "init_kwargs": {
+                "building_table": self.BUILDING_TABLE,
+                "energy_area_id": self.ENERGY_AREA_ID,
+                "building_area_id": self.BUILDING_AREA_ID,
+                "scenario_file_name": self.SCENARIO_FILE_NAME,
+                "temperature_array_file_path": self.TEMPERATURE_ARRAY_FILE_NAME,
+                "hourly_data_format": self.HOURLY_DATA_FORMAT,
+                "incremental": self.INCREMENTAL,
+                "dtype": self.DTYPE.name,
+                "streaming": self.STREAMING,
+                "seed": self.SEED
+                },
+            "shared_arrays": shared_arrays,
+            "reference_result": reference_result,
+            "PROFET_COLUMNS": list(self.PROFET_DATA.columns),
+            "SOLARPANEL_COLUMNS": list(self.SOLARPANEL_DATA.columns),
+            "address_dict": {key: self.address_dict[key] for key in self.address_keys},
+            "address_keys": self.address_keys,
+            "WINTER_MAX": self.WINTER_MAX,
+            "SUMMER_MAX": self.SUMMER_MAX
+            }
+        return worker_state
+
+    def __parallel_simulations(self, df, energy_dicts_of_dicts, scenario_names, rngs):
+        shared_memory_blocks = []
+        try:
+            worker_state = self.__share_inputs(shared_memory_blocks)
+            workers = min(self.WORKERS, len(scenario_names))
+            with ProcessPoolExecutor(max_workers = workers, initializer = _init_scenario_worker, initargs = (worker_state,)) as executor:
+                futures = [executor.submit(_run_scenario_worker, df, energy_dicts, scenario_name, rng) for energy_dicts, scenario_name, rng in zip(energy_dicts_of_dicts, scenario_names, rngs)]
+                for future in futures:
+                    self.run_report.records.extend(future.result()) # feil i et scenario kastes videre her
+        finally:
+            for block in shared_memory_blocks:
+                block.close()
+                block.unlink()
+
     def run_simulations(self, df):
         energy_dicts_of_dicts, scenario_names = self.__read_scenario_file_excel()
+        # en uavhengig generator per scenario, uavhengig av rekkefølge og antall prosesser
+        seed_sequences = np.random.SeedSequence(self.SEED).spawn(len(scenario_names))
+        rngs = [np.random.default_rng(seed_sequence) for seed_sequence in seed_sequences]
         
-        df = self.__default_simulation(df = df, energy_dicts = energy_dicts_of_dicts[0], scenario_name = scenario_names[0])
+        if self.MONTE_CARLO > 0:
+            with self.run_report.stage("create_scenario", rows = len(df) * self.MONTE_CARLO * len(scenario_names)):
+                draws_per_scenario = self.__monte_carlo_draws(df, energy_dicts_of_dicts, seed_sequences)
+            for draws, scenario_name in zip(draws_per_scenario, scenario_names):
+                with self.run_report.stage("monte_carlo", rows = len(df), scenario = scenario_name):
+                    self.monte_carlo_simulation(df = df, draws = draws, scenario_name = scenario_name)
+            return
+        
+        df = self.__default_simulation(df = df, energy_dicts = energy_dicts_of_dicts[0], scenario_name = scenario_names[0], rng = rngs[0])
         original_df = df.copy()
         
-        for i in range(1, len(scenario_names)):
-            self.__modified_simulation(df = original_df, energy_dicts = energy_dicts_of_dicts[i], scenario_name = scenario_names[i])
+        if self.WORKERS > 1 and len(scenario_names) > 2:
+            self.__parallel_simulations(df = original_df, energy_dicts_of_dicts = energy_dicts_of_dicts[1:], scenario_names = scenario_names[1:], rngs = rngs[1:])
+        else:
+            for i in range(1, len(scenario_names)):
+                self.__modified_simulation(df = original_df, energy_dicts = energy_dicts_of_dicts[i], scenario_name = scenario_names[i], rng = rngs[i])
     
     def main(self):
         warnings.simplefilter(action='ignore', category=FutureWarning)
-        df = self.import_xlsx() # en df for alle planforslag
+        try:
+            with self.run_report.stage("import") as stage:
+                df = self.import_xlsx() # en df for alle planforslag
+                temperature_array = self.__load_temperature_array()
+                stage["rows"] = len(df)
+            #self.preprocess_profet_data(temperature_array = temperature_array) # preprocess profet data
+            with self.run_report.stage("preprocess_ashp"):
+                self.preprocess_luft_luft_varmepumpe(temperature_array = temperature_array) # preprocess ashp
+            self.run_simulations(df)
+        finally:
+            # skrives også når en kjøring feiler, med stegene som ble fullført
+            self.run_report.write("output/run_report.json", options = self.__report_options())
+
+    def __report_options(self):
+        return {
+            "building_table": self.BUILDING_TABLE,
+            "scenario_file_name": self.SCENARIO_FILE_NAME,
+            "hourly_data_format": self.HOURLY_DATA_FORMAT,
+            "workers": self.WORKERS,
+            "incremental": self.INCREMENTAL,
+            "seed": self.SEED,
+            "monte_carlo": self.MONTE_CARLO,
+            "dtype": self.DTYPE.name,
+            "streaming": self.STREAMING
+            }
+
+    def main_preprocess_profet(self):
         temperature_array = self.__load_temperature_array()
-        #self.preprocess_profet_data(temperature_array = temperature_array) # preprocess profet data
-        self.preprocess_luft_luft_varmepumpe(temperature_array = temperature_array) # preprocess ashp
-        self.run_simulations(df)
-
-#test 
-energy_analysis = EnergyAnalysis(
-    building_table = "building_table_kringsjå_oppdatert.xlsx",
-    energy_area_id = "energiomraadeid",
-    building_area_id = "bygningsomraadeid",
-    scenario_file_name = "input/scenarier.xlsx",
-    temperature_array_file_path = "input/utetemperatur.xlsx")
-energy_analysis.main()
\ No newline at end of file
+        return self.preprocess_profet_data(temperature_array = temperature_array)
+
+    def main_preprocess_ashp(self):
+        temperature_array = self.__load_temperature_array()
+        self.preprocess_luft_luft_varmepumpe(temperature_array = temperature_array)
+
+#-- prosesspool for scenarioene
+_WORKER_ENERGY_ANALYSIS = None
+_WORKER_SHARED_MEMORY = []
+
+def _share_array(array, shared_memory_blocks):
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype = array.dtype, buffer = block.buf)[...] = array
+    shared_memory_blocks.append(block)
+    return block.name, array.shape, array.dtype.str
+
+def _attach_shared_array(shared_array):
+    name, shape, dtype = shared_array
+    block = shared_memory.SharedMemory(name = name)
+    _WORKER_SHARED_MEMORY.append(block) # holder blokken i live like lenge som prosessen
+    array = np.ndarray(shape, dtype = dtype, buffer = block.buf)
+    array.flags.writeable = False
+    return array
+
+def _init_scenario_worker(worker_state):
+    global _WORKER_ENERGY_ANALYSIS
+    shared_arrays = worker_state["shared_arrays"]
+    energy_analysis = EnergyAnalysis(**worker_state["init_kwargs"])
+    energy_analysis.PROFET_DATA = pd.DataFrame(_attach_shared_array(shared_arrays["PROFET_DATA"]), columns = worker_state["PROFET_COLUMNS"], copy = False)
+    energy_analysis.SOLARPANEL_DATA = pd.DataFrame(_attach_shared_array(shared_arrays["SOLARPANEL_DATA"]), columns = worker_state["SOLARPANEL_COLUMNS"], copy = False)
+    energy_analysis.temperature_array = _attach_shared_array(shared_arrays["temperature_array"])
+    ashp_table = _attach_shared_array(shared_arrays["ASHP_TABLE"])
+    energy_analysis.P_HP_TABLE = ashp_table[0:3].T
+    energy_analysis.COP_HP_TABLE = ashp_table[3:6].T
+    energy_analysis.INTERPOLATE_HP_TABLE = ashp_table[6]
+    energy_analysis.address_dict = worker_state["address_dict"]
+    energy_analysis.address_keys = worker_state["address_keys"]
+    energy_analysis.WINTER_MAX = worker_state["WINTER_MAX"]
+    energy_analysis.SUMMER_MAX = worker_state["SUMMER_MAX"]
+    if worker_state["reference_result"] is not None:
+        reference_df, reference_hourly_matrices = worker_state["reference_result"]
+        if isinstance(reference_hourly_matrices, str):
+            energy_analysis.reference_result = worker_state["reference_result"]
+        else:
+            energy_analysis.reference_result = (reference_df, {datafield: _attach_shared_array(shared_hourly_matrix) for datafield, shared_hourly_matrix in reference_hourly_matrices.items()})
+    _WORKER_ENERGY_ANALYSIS = energy_analysis
+
+def _run_scenario_worker(df, energy_dicts, scenario_name, rng):
+    # målingene for scenarioet sendes tilbake og slås sammen med hovedprosessens rapport
+    run_report = _WORKER_ENERGY_ANALYSIS.run_report
+    run_report.records = []
+    with run_report.stage("scenario", rows = len(df), scenario = scenario_name):
+        with run_report.stage("create_scenario", rows = len(df)):
+            df = _WORKER_ENERGY_ANALYSIS.modify_scenario(df = df, energy_dicts = energy_dicts, rng = rng)
+        _WORKER_ENERGY_ANALYSIS.run_simulation(df = df, scenario_name = scenario_name, reference_result = _WORKER_ENERGY_ANALYSIS.reference_result)
+    return run_report.records
+
+#-- kommandolinje
+def cli(argv = None):
+    parser = argparse.ArgumentParser(prog = "energyanalysis", description = "Energianalyse av byggtabell og scenarier")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+    common = argparse.ArgumentParser(add_help = False)
+    common.add_argument("--building-table", default = "building_table_kringsjå_oppdatert.xlsx", help = "filnavn i input/")
+    common.add_argument("--scenario-file", default = "input/scenarier.xlsx")
+    common.add_argument("--temperature-file", default = "input/utetemperatur.xlsx")
+    common.add_argument("--energy-area-id", default = "energiomraadeid")
+    common.add_argument("--building-area-id", default = "bygningsomraadeid")
+    simulate = subparsers.add_parser("simulate", parents = [common], help = "kjør alle scenarier i scenariofilen")
+    simulate.add_argument("--workers", type = int, default = 1)
+    simulate.add_argument("--seed", type = int, default = None)
+    simulate.add_argument("--incremental", action = "store_true")
+    simulate.add_argument("--monte-carlo", type = int, default = 0, help = "antall trekninger per scenario")
+    simulate.add_argument("--hourly-format", choices = ["parquet", "csv"], default = "parquet")
+    simulate.add_argument("--streaming", action = "store_true", help = "skriv timeverdiene til disk per chunk")
+    simulate.add_argument("--dtype", choices = ["float64", "float32"], default = "float64", help = "lagringspresisjon for timeverdiene")
+    profet = subparsers.add_parser("preprocess-profet", parents = [common], help = "hent PROFet-profiler til src/profet_data.csv")
+    profet.add_argument("--concurrency", type = int, default = 8)
+    profet.add_argument("--token-url", default = EnergyAnalysis.PROFET_TOKEN_URL)
+    profet.add_argument("--api-url", default = EnergyAnalysis.PROFET_API_URL)
+    subparsers.add_parser("preprocess-ashp", parents = [common], help = "bygg ytelsestabellen for luft-luft-varmepumpe")
+    args = parser.parse_args(argv)
+    #--
+    kwargs = dict(
+        building_table = args.building_table,
+        energy_area_id = args.energy_area_id,
+        building_area_id = args.building_area_id,
+        scenario_file_name = args.scenario_file,
+        temperature_array_file_path = args.temperature_file)
+    if args.command == "simulate":
+        energy_analysis = EnergyAnalysis(**kwargs, hourly_data_format = args.hourly_format, workers = args.workers, incremental = args.incremental, seed = args.seed, monte_carlo = args.monte_carlo, dtype = args.dtype, streaming = args.streaming)
+        energy_analysis.main()
+    elif args.command == "preprocess-profet":
+        energy_analysis = EnergyAnalysis(**kwargs, profet_concurrency = args.concurrency, profet_token_url = args.token_url, profet_api_url = args.api_url)
+        energy_analysis.main_preprocess_profet()
+    elif args.command == "preprocess-ashp":
+        energy_analysis = EnergyAnalysis(**kwargs)
+        energy_analysis.main_preprocess_ashp()
+
+if __name__ == "__main__":
+    cli()
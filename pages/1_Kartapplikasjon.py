@@ -7,12 +7,16 @@ import geopandas as gpd
 import plotly.express as px
 import plotly.graph_objects as go
 import statsmodels.api as sm
-from folium.plugins import MarkerCluster
+from folium.plugins import MarkerCluster, FastMarkerCluster
 from streamlit_folium import st_folium
-from shapely.geometry import Point, Polygon
+from shapely.geometry import shape
+from shapely import STRtree, make_valid
 from folium.plugins import Fullscreen
 import time
 import base64
+import json
+from calendar_aggregation import aggregate
+from selection_cache import SelectionAggregateCache, selection_digest
 
 def streamlit_settings(title, icon):
     st.set_page_config(page_title=title, page_icon=icon, layout="wide")
@@ -38,7 +42,15 @@ def read_position(filepath):
     return df_position
 
 @st.cache_resource(show_spinner=False)
-def create_map(df_position):
+def create_map(df_position, compact_markers = True):
+    MEASURE_COLUMNS = ["grunnvarme", "fjernvarme", "solceller", "luft_luft_varmepumpe", "oppgraderes"]
+    TEXT_COLOR_MAP = {
+        "G": "#48a23f",
+        "F": "#1d3c34",
+        "S": "#FFC358",
+        "L": "black",
+        "O": "#b7dc8f",
+    }
     def add_wms_layer_to_map(url, layer, layer_name, opacity = 0.5, show = False):
         folium.WmsTileLayer(
             url = url,
@@ -64,23 +76,8 @@ def create_map(df_position):
     def styling_function(row):
         popup_text = ""
         text = ""
-        rows = row[
-            [
-                "grunnvarme",
-                "fjernvarme",
-                "solceller",
-                "luft_luft_varmepumpe",
-                "oppgraderes",
-            ]
-        ]
+        rows = row[MEASURE_COLUMNS]
         text = "".join(rows.index[rows].str[0].str.upper())
-        TEXT_COLOR_MAP = {
-            "G": "#48a23f",
-            "F": "#1d3c34",
-            "S": "#FFC358",
-            "L": "black",
-            "O": "#b7dc8f",
-        }
         try:
             text_color = TEXT_COLOR_MAP[text]
         except Exception:
@@ -112,6 +109,52 @@ def create_map(df_position):
                 tooltip=tooltip_text,
                 icon=icon,
             ).add_to(marker_cluster)
+
+    def add_compact_marker_cluster_to_map(df):
+        # alle bygg sendes som én tabell [y, x, tiltak..., adresse, areal, bygningstype], og ikon og tooltip lages i nettleseren
+        # med samme callback for alle bygg, slik at siden ikke vokser med én Marker/BeautifyIcon per bygg
+        flags = df[MEASURE_COLUMNS].astype(str).isin(["True", "1", "1.0"]).astype(int)
+        data = pd.concat([
+            df[["y", "x"]].astype(float),
+            flags,
+            df["har_adresse"].fillna("").astype(str),
+            df["bruksareal_totalt"].fillna(0),
+            df["profet_bygningstype"].fillna("").astype(str),
+            ], axis=1).astype(object).values.tolist()
+        callback = """
+            var callback = function (row) {
+                var letters = %s;
+                var colors = %s;
+                var text = "";
+                for (var i = 0; i < letters.length; i++) {
+                    if (row[2 + i]) {
+                        text += letters[i];
+                    }
+                }
+                var color = colors[text] || "black";
+                var icon = L.divIcon({
+                    className: "",
+                    iconSize: [20, 20],
+                    iconAnchor: [10, 10],
+                    html: '<div style="box-sizing:border-box;width:20px;height:20px;border-radius:50%%;border:1px solid ' + color + ';color:' + color + ';background:white;font:bold 10px/18px sans-serif;text-align:center;">' + text + '</div>'
+                });
+                var n = letters.length + 2;
+                var area = String(row[n + 1]).split(".");
+                area[0] = area[0].replace(/\B(?=(\d{3})+(?!\d))/g, " ");
+                var tooltip = (row[n] + " (<strong>" + area.join(".") + " m²</strong>)<br><em>" + row[n + 2] + "</em>").replace(/,/g, " ");
+                var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+                marker.bindTooltip(tooltip);
+                return marker;
+            };""" % (json.dumps([column[0].upper() for column in MEASURE_COLUMNS]), json.dumps(TEXT_COLOR_MAP))
+        marker_cluster = FastMarkerCluster(
+            data=data,
+            callback=callback,
+            name="1000 clustered icons",
+            overlay=False,
+            control=False,
+            options={"disableClusteringAtZoom": 13},
+        ).add_to(folium_map)
+        return marker_cluster
     
     def add_geojson_to_map(
         file_path,
@@ -151,12 +194,14 @@ def create_map(df_position):
         )           
     folium.TileLayer("CartoDB positron", name="Bakgrunnskart").add_to(folium_map)
     folium.TileLayer("https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}", name="Flyfoto", attr="Flyfoto").add_to(folium_map)
-    geometry = [Point(xy) for xy in zip(df_position['x'], df_position['y'])]
-    gdf_buildings = gpd.GeoDataFrame(df_position, geometry=geometry, crs='EPSG:4326')
+    gdf_buildings = gpd.GeoDataFrame(df_position, geometry=gpd.points_from_xy(df_position['x'], df_position['y']), crs='EPSG:4326')
     #gdf_buildings = gdf_buildings.drop(columns=['y', 'x'])
     #geojson_buildings = gdf_buildings.to_json()
-    marker_cluster = add_marker_cluster_to_map()
-    add_building_to_marker_cluster(marker_cluster=marker_cluster, scenario_name=selected_scenario_name, df=df_position)
+    if compact_markers == True:
+        marker_cluster = add_compact_marker_cluster_to_map(df=df_position)
+    else:
+        marker_cluster = add_marker_cluster_to_map()
+        add_building_to_marker_cluster(marker_cluster=marker_cluster, scenario_name=selected_scenario_name, df=df_position)
     add_wms_layer_to_map(
         url = "https://geo.ngu.no/mapserver/LosmasserWMS2?request=GetCapabilities&service=WMS",
         layer = "Losmasse_flate",
@@ -239,14 +284,32 @@ def display_map(folium_map):
         )
     return st_map
 
-def spatial_join(gdf_buildings):
+@st.cache_resource(show_spinner=False)
+def build_spatial_index(filepath, building_area_id):
+    # ett STR-tre over byggpunktene per scenario og bygningsmasse, bygges én gang
+    df_position = read_position(filepath)
+    df_position = df_position[df_position['bygningsomraadeid'] == building_area_id].reset_index(drop=True)
+    geometry = gpd.points_from_xy(df_position['x'], df_position['y'], crs='EPSG:4326')
+    return df_position, geometry, STRtree(np.asarray(geometry))
+
+def select_buildings(spatial_index, polygon):
+    # radnumrene til byggene som ligger inne i polygonet (også multipolygon og polygon med hull)
+    df_position, geometry, tree = spatial_index
+    if not polygon.is_valid:
+        polygon = make_valid(polygon) # f.eks. et polygon som krysser seg selv
+    return np.sort(tree.query(polygon, predicate="contains"))
+
+def spatial_join(spatial_index):
     try:
-        polygon = Polygon(st_map["last_active_drawing"]["geometry"]["coordinates"][0])
-        polygon_gdf = gpd.GeoDataFrame(index=[0], geometry=[polygon])
-        filtered_gdf = gpd.sjoin(gdf_buildings, polygon_gdf, op="within")
+        polygon = shape(st_map["last_active_drawing"]["geometry"])
+        if polygon.geom_type not in ["Polygon", "MultiPolygon"]:
+            raise ValueError(polygon.geom_type)
     except Exception:
         st.info('Tegn et polygon for å gjøre et utvalg av bygg', icon="ℹ️")
         st.stop()
+    df_position, geometry, tree = spatial_index
+    rows = select_buildings(spatial_index, polygon)
+    filtered_gdf = gpd.GeoDataFrame(df_position.iloc[rows], geometry=geometry[rows], crs='EPSG:4326')
     return filtered_gdf
 
 def scenario_comparison():
@@ -255,7 +318,7 @@ def scenario_comparison():
     scenario_comparison = True
     return scenario_comparison
 
-def building_plan_filter(df_position):
+def building_plan_option():
     with st.sidebar:
         selected_buildings_option = st.radio(
             "Velg bygningsmasse", 
@@ -269,13 +332,49 @@ def building_plan_filter(df_position):
             "Eksisterende bygningsmasse + byggetrinn 3" : "EksisterendeOgBT3",
         }
         building_area_id = selected_buildings_option_map[selected_buildings_option]
-    df_position = df_position[df_position['bygningsomraadeid'] == building_area_id]
-    return df_position
-
-@st.cache_resource(show_spinner=False)
-def read_hourly_data(object_ids, filepath):    
-    df_hourly_data = pd.read_csv(filepath_or_buffer=f"{filepath}_timedata.csv", usecols=object_ids)
-    return df_hourly_data
+    return building_area_id
+
+def find_hourly_data(filepath):
+    # én Parquet-fil, strømmet kjøring (mappe med deler) eller csv
+    for hourly_data_path in [f"{filepath}_timedata.parquet", f"{filepath}_timedata/manifest.json", f"{filepath}_timedata.csv"]:
+        if os.path.exists(hourly_data_path):
+            return hourly_data_path
+
+HOURLY_TENSOR_CACHE_ENTRIES = 8 # to versjoner av hvert av de fire scenarioene; eldre tensorer (f.eks. fra før en ny simulering) kastes
+
+@st.cache_resource(show_spinner=False, max_entries=HOURLY_TENSOR_CACHE_ENTRIES)
+def read_hourly_tensor(hourly_data_path, modified_time):
+    # hele scenarioet lastes én gang (per versjon av filen) til (datafelt x timer x bygg) og objectid -> kolonne
+    if hourly_data_path.endswith(".parquet"):
+        df_hourly_data = pd.read_parquet(hourly_data_path)
+    elif hourly_data_path.endswith("manifest.json"):
+        with open(hourly_data_path, encoding="utf-8") as file:
+            manifest = json.load(file)
+        folder = os.path.dirname(hourly_data_path)
+        frames = [pd.read_parquet(f"{folder}/{manifest['parts'][0]['file']}", columns=["ID"])]
+        frames += [pd.read_parquet(f"{folder}/{part['file']}", columns=part["ids"]) for part in manifest["parts"]]
+        df_hourly_data = pd.concat(frames, axis=1)
+    else:
+        df_hourly_data = pd.read_csv(hourly_data_path, index_col=0)
+    ids = df_hourly_data["ID"].to_numpy()
+    building_columns = [column for column in df_hourly_data.columns if column not in ["ID", "scenario"]]
+    values = df_hourly_data[building_columns].to_numpy()
+    fields = list(pd.unique(ids))
+    tensor = np.nan_to_num(np.stack([values[ids == field] for field in fields]), copy=False) # NaN telles som 0, som før
+    return fields, tensor, pd.Index(building_columns)
+
+def show_run_report(file_path):
+    # kjøretid per steg fra siste beregning (output/run_report.json)
+    if not os.path.exists(file_path):
+        return
+    with st.sidebar:
+        if st.checkbox("Vis kjøretid for beregningen", value=False):
+            with open(file_path, encoding="utf-8") as file:
+                run_report = json.load(file)
+            df_summary = pd.DataFrame(run_report["summary"])
+            df_summary["scenario"] = df_summary["scenario"].fillna("")
+            st.caption(f"Beregnet {run_report['created']}")
+            st.dataframe(df_summary[["scenario", "stage", "seconds", "cpu_seconds", "rows", "peak_rss_mb"]], hide_index=True)
 
 def select_scenario():
     with st.sidebar:
@@ -284,74 +383,48 @@ def select_scenario():
         scenario_name = st.radio(label='Velg scenario', options=option_list)
     return scenario_name
 
-def get_dict_arrays(df_hourly_data):
-    df_thermal = df_hourly_data[df_hourly_data['ID'] == '_termisk_energibehov'].reset_index(drop = True).drop('ID', axis=1).assign(sum=lambda x: x.sum(axis=1))
-    df_electric = df_hourly_data[df_hourly_data['ID'] == '_elektrisk_energibehov'].reset_index(drop = True).drop('ID', axis=1).assign(sum=lambda x: x.sum(axis=1))
-    df_spaceheating = df_hourly_data[df_hourly_data['ID'] == '_romoppvarming_energibehov'].reset_index(drop = True).drop('ID', axis=1).assign(sum=lambda x: x.sum(axis=1))
-    df_dhw = df_hourly_data[df_hourly_data['ID'] == '_tappevann_energibehov'].reset_index(drop = True).drop('ID', axis=1).assign(sum=lambda x: x.sum(axis=1))
-    df_elspecific = df_hourly_data[df_hourly_data['ID'] == '_elspesifikt_energibehov'].reset_index(drop = True).drop('ID', axis=1).assign(sum=lambda x: x.sum(axis=1))
-    df_grid = df_hourly_data[df_hourly_data['ID'] == '_nettutveksling_energi_liste'].reset_index(drop = True).drop('ID', axis=1).assign(sum=lambda x: x.sum(axis=1))
-    df_total = df_spaceheating + df_dhw + df_elspecific
-    df_total_delivered = df_thermal + df_electric
-    df_produced_heat = df_spaceheating + df_dhw - df_thermal
-    df_produced_el = df_elspecific - df_electric
-    df_thermal_total = df_spaceheating + df_dhw
+def get_dict_arrays(hourly_tensor, object_ids):
+    # utvalget summeres per datafelt som ett matriseprodukt med en 0/1-vektor over byggaksen,
+    # de avledede seriene er vektoraritmetikk på de summerte radene
+    fields, tensor, building_index = hourly_tensor
+    columns = building_index.get_indexer(pd.unique(object_ids))
+    selected = np.zeros(len(building_index), dtype=float)
+    selected[columns[columns >= 0]] = 1
+    rows = tensor.reshape(-1, len(building_index))
+    if rows.dtype == np.float64:
+        summed = rows @ selected
+    else:
+        # float32-lagring (--dtype float32) summeres i float64, blokk for blokk for å slippe en kopi av hele tensoren
+        summed = np.empty(len(rows))
+        for i in range(0, len(rows), 2048):
+            summed[i:i+2048] = rows[i:i+2048].astype(float) @ selected
+    summed = dict(zip(fields, summed.reshape(len(fields), -1)))
+    thermal = summed['_termisk_energibehov']
+    electric = summed['_elektrisk_energibehov']
+    spaceheating = summed['_romoppvarming_energibehov']
+    dhw = summed['_tappevann_energibehov']
+    elspecific = summed['_elspesifikt_energibehov']
+    grid = summed['_nettutveksling_energi_liste']
     dict_arrays = {
-        'thermal': df_thermal['sum'],
-        'thermal_total' : df_thermal_total['sum'],
-        'electric': df_electric['sum'],
-        'spaceheating': df_spaceheating['sum'],
-        'dhw': df_dhw['sum'],
-        'elspecific': df_elspecific['sum'],
-        'grid': df_grid['sum'],
-        'total': df_total['sum'],
-        'total_delivered' : df_total_delivered['sum'],
-        'produced_heat': df_produced_heat['sum'],
-        'produced_el' : df_produced_el['sum']}
+        'thermal': thermal,
+        'thermal_total' : spaceheating + dhw,
+        'electric': electric,
+        'spaceheating': spaceheating,
+        'dhw': dhw,
+        'elspecific': elspecific,
+        'grid': grid,
+        'total': spaceheating + dhw + elspecific,
+        'total_delivered' : thermal + electric,
+        'produced_heat': spaceheating + dhw - thermal,
+        'produced_el' : elspecific - electric}
     return dict_arrays
 
-def hour_to_month(hourly_array, aggregation='sum'):
-    result_array = []
-    temp_value = 0 if aggregation in ['sum', 'max'] else []
-    count = 0 if aggregation == 'average' else None
-    for index, value in enumerate(hourly_array):
-        if np.isnan(value):
-            value = 0
-        if aggregation == 'sum':
-            temp_value += value
-        elif aggregation == 'average':
-            temp_value.append(value)
-            count += 1
-        elif aggregation == 'max' and value > temp_value:
-            temp_value = value
-        if index in [744, 1416, 2160, 2880, 3624, 4344, 5088, 5832, 6552, 7296, 8016, 8759]:
-            if aggregation == 'average':
-                if count != 0:
-                    result_array.append(sum(temp_value) / count)
-                else:
-                    result_array.append(0)
-                temp_value = []
-                count = 0
-            else:
-                result_array.append(temp_value)
-                temp_value = 0 if aggregation in ['sum', 'max'] else []
-    return result_array
-
-def get_dict_months(dict_arrays, aggregation):
-    dict_months = {
-        'thermal': hour_to_month(dict_arrays['thermal'], aggregation),
-        'thermal_total': hour_to_month(dict_arrays['thermal_total'], aggregation),
-        'electric': hour_to_month(dict_arrays['electric'], aggregation),
-        'spaceheating': hour_to_month(dict_arrays['spaceheating'], aggregation),
-        'dhw': hour_to_month(dict_arrays['dhw'], aggregation),
-        'elspecific': hour_to_month(dict_arrays['elspecific'], aggregation),
-        'grid': hour_to_month(dict_arrays['grid'], aggregation),
-        'total': hour_to_month(dict_arrays['total'], aggregation),
-        'total_delivered': hour_to_month(dict_arrays['total_delivered'], aggregation),
-        'produced_heat': hour_to_month(dict_arrays['produced_heat'], aggregation),
-        'produced_el': hour_to_month(dict_arrays['produced_el'], aggregation)
-    }
-    return dict_months
+def get_dict_months(dict_arrays):
+    # alle serier og aggregeringer (sum, maks, snitt) per kalendermåned i ett kall
+    keys = list(dict_arrays.keys())
+    monthly = aggregate(np.vstack([np.asarray(dict_arrays[key], dtype=float) for key in keys]), frequency="month", aggregations=("sum", "max", "average"))
+    monthly["max"] = np.maximum(monthly["max"], 0) # som før: makseffekten per måned er minst 0
+    return {aggregation: {key: monthly[aggregation][i].tolist() for i, key in enumerate(keys)} for aggregation in monthly}
 
 def calculate_key_values(monthly_dict, aggregation='sum'):
     if aggregation == 'sum':
@@ -376,6 +449,33 @@ def get_key_values(monthly_dict, aggregation):
     }
     return dict_months
 
+def get_results(hourly_tensor, object_ids):
+    dict_arrays = get_dict_arrays(hourly_tensor, object_ids)
+    dict_months = get_dict_months(dict_arrays)
+    dict_months_sum = dict_months['sum']
+    dict_months_max = dict_months['max']
+    dict_months_average = dict_months['average']
+    dict_sum = get_key_values(dict_months_sum, aggregation='sum')
+    dict_max = get_key_values(dict_months_max, aggregation='max')
+    return {
+        'dict_arrays' : dict_arrays,
+        'dict_months_sum' : dict_months_sum,
+        'dict_months_max' : dict_months_max,
+        'dict_months_average' : dict_months_average,
+        'dict_sum' : dict_sum,
+        'dict_max' : dict_max
+    }
+
+@st.cache_resource(show_spinner=False)
+def selection_aggregate_cache():
+    # ett LRU-buffer for ferdige aggregater per (scenario, utvalg), delt mellom økter
+    return SelectionAggregateCache()
+
+def show_cache_stats(aggregate_cache):
+    with st.sidebar:
+        if st.checkbox("Vis buffer for utvalg", value=False):
+            st.dataframe(pd.DataFrame([aggregate_cache.stats()]), hide_index=True)
+
 def metric(text, color, energy, effect, energy_reduction = 0, effect_reduction = 0):
     energy = int(round(energy, -3))
     effect = int(round(effect, 1))
@@ -723,20 +823,22 @@ PRODUCED_EL_COLOR = "lightblue"
 SCENARIO_NAMES = find_scenario_names("output")
 #SCENARIO_NAMES = ['Referansesituasjon', 'Fjernvarme for Ringve VGS', 'Høyblokker med bergvarme', 'Solceller på alle tak']
 selected_scenario_name = select_scenario()
-df_position = read_position(f'output/{selected_scenario_name}')
-df_position = building_plan_filter(df_position)
+building_area_id = building_plan_option()
+spatial_index = build_spatial_index(f'output/{selected_scenario_name}', building_area_id)
+df_position = spatial_index[0]
 SCENARIO_COMPARISON = scenario_comparison()
 folium_map, gdf_buildings = create_map(df_position = df_position)
 with COLUMN_1:
     st_map = display_map(folium_map)
 with COLUMN_2:
-    filtered_gdf = spatial_join(gdf_buildings)
+    filtered_gdf = spatial_join(spatial_index)
 
 object_ids = filtered_gdf['objectid'].astype(str)
-object_ids['ID'] = 'ID'
 
 
 results = {}
+aggregate_cache = selection_aggregate_cache()
+selection = selection_digest(object_ids)
 if SCENARIO_COMPARISON == False:
     SCENARIO_NAMES = [selected_scenario_name]
 
@@ -744,22 +846,10 @@ i = 0
 increment = int(100/len(SCENARIO_NAMES))
 for scenario_name in SCENARIO_NAMES:
     my_bar.progress(i, text = f"Laster inn {scenario_name}...")  
-    df_hourly_data = read_hourly_data(object_ids, f"output/{scenario_name}")
-    dict_arrays = get_dict_arrays(df_hourly_data)
-    dict_months_sum = get_dict_months(dict_arrays, aggregation='sum')
-    dict_months_max = get_dict_months(dict_arrays, aggregation='max')
-    dict_months_average = get_dict_months(dict_arrays, aggregation='average')
-    dict_sum = get_key_values(dict_months_sum, aggregation='sum')
-    dict_max = get_key_values(dict_months_max, aggregation='max')
-
-    results[scenario_name] = {
-        'dict_arrays' : dict_arrays,
-        'dict_months_sum' : dict_months_sum,
-        'dict_months_max' : dict_months_max,
-        'dict_months_average' : dict_months_average,
-        'dict_sum' : dict_sum,
-        'dict_max' : dict_max
-    }
+    hourly_data_path = find_hourly_data(f"output/{scenario_name}")
+    modified_time = os.path.getmtime(hourly_data_path)
+    key = (scenario_name, hourly_data_path, modified_time, selection)
+    results[scenario_name] = aggregate_cache.get_or_compute(key, lambda: get_results(read_hourly_tensor(hourly_data_path, modified_time), object_ids))
     i = i + increment
         
 ######################################################################
@@ -805,6 +895,8 @@ my_bar.progress(100, text="Fullført")
 
 
 
+show_run_report("output/run_report.json")
+show_cache_stats(aggregate_cache)
 end_time = time.time()
 #with st.sidebar:
 #    st.title(f"Tidsbruk: {round((end_time - start_time),2)} sekunder")
@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+import argparse
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Lokal erstatning for PROFet (token + /api/Profet) for testing og benchmarking uten nett.
+# Profilene er syntetiske, men har samme format og lengde som svaret fra PROFet.
+
+HOURS = 8760
+
+# kWh/m² per time for hver profil: (romoppvarming per grad under 17 °C, tappevann, elspesifikt)
+TYPE_FACTORS = {
+    "Hou": (0.0040, 0.0030, 0.0035),
+    "Apt": (0.0035, 0.0035, 0.0030),
+    "Off": (0.0030, 0.0008, 0.0060),
+    "Shp": (0.0030, 0.0006, 0.0080),
+    "Htl": (0.0040, 0.0040, 0.0060),
+    "Kdg": (0.0040, 0.0012, 0.0040),
+    "Sch": (0.0035, 0.0010, 0.0040),
+    "Uni": (0.0035, 0.0010, 0.0050),
+    "CuS": (0.0035, 0.0010, 0.0045),
+    "Nsh": (0.0045, 0.0035, 0.0050),
+    "Other": (0.0035, 0.0015, 0.0050)
+    }
+
+STANDARD_FACTORS = {"Reg": 1.0, "Eff-E": 0.6, "Eff-N": 0.5, "Vef": 0.35}
+
+def standin_temperature(hours = HOURS):
+    hour = np.arange(hours)
+    return 5 - 12 * np.cos(2 * np.pi * hour / HOURS) - 3 * np.cos(2 * np.pi * hour / 24)
+
+def standin_profiles(request_data):
+    temperature = request_data.get("TimeSeries", {}).get("Tout")
+    temperature = np.asarray(temperature, dtype=float) if temperature else standin_temperature()
+    hour = np.arange(len(temperature))
+    daily_shape = 1 + 0.4 * np.sin(2 * np.pi * (hour % 24 - 8) / 24)
+    spaceheating = np.zeros(len(temperature))
+    dhw = np.zeros(len(temperature))
+    electric = np.zeros(len(temperature))
+    for building_type, areas in request_data["Areas"].items():
+        spaceheating_factor, dhw_factor, electric_factor = TYPE_FACTORS.get(building_type, TYPE_FACTORS["Other"])
+        for standard, area in areas.items():
+            standard_factor = STANDARD_FACTORS.get(standard, 1.0)
+            spaceheating += area * standard_factor * spaceheating_factor * np.clip(17 - temperature, 0, None)
+            dhw += area * dhw_factor * daily_shape
+            electric += area * electric_factor * daily_shape
+    return {"Electric": electric.tolist(), "DHW": dhw.tolist(), "SpaceHeating": spaceheating.tolist()}
+
+class ProfetStandinHandler(BaseHTTPRequestHandler):
+    def __send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/connect/token":
+            self.__send_json(200, {"access_token": "standin", "token_type": "Bearer", "expires_in": 3600})
+        elif self.path == "/api/Profet":
+            if self.headers.get("Authorization") != "Bearer standin":
+                self.__send_json(401, {"error": "invalid_token"})
+            else:
+                self.__send_json(200, standin_profiles(json.loads(body)))
+        else:
+            self.__send_json(404, {"error": "not_found"})
+
+    def log_message(self, format, *args):
+        pass
+
+def start_standin_server(host = "127.0.0.1", port = 0):
+    # port 0 gir en ledig port; oauthlib krever ellers https
+    os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+    server = ThreadingHTTPServer((host, port), ProfetStandinHandler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    base_url = f"http://{host}:{server.server_address[1]}"
+    return server, base_url
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Lokal PROFet-erstatning")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8000)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), ProfetStandinHandler)
+    print(f"PROFet-erstatning på http://{args.host}:{args.port} (sett OAUTHLIB_INSECURE_TRANSPORT=1 i klienten)")
+    server.serve_forever()
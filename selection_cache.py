@@ -0,0 +1,85 @@
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Ferdige aggregater (results[scenario]) per utvalg av bygg, delt mellom økter og reruns.
+# Nøkkelen er f.eks. (scenario, timedatafil, endringstid, digest av sorterte objectid-er), og eldste utvalg kastes når minnetaket nås.
+
+MAX_MEGABYTES = 256
+
+def selection_digest(object_ids):
+    # samme bygg i en annen rekkefølge (eller med duplikater) gir samme digest
+    object_ids = np.unique(np.asarray(object_ids, dtype=str))
+    return hashlib.sha1("\n".join(object_ids).encode("utf-8")).hexdigest()
+
+def nbytes(value):
+    # omtrentlig minnebruk for dict/list/array/tall, brukes til minnetaket
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(nbytes(key) + nbytes(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+def freeze(value):
+    # bufrede arrays deles mellom økter og skal ikke endres på plass
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, dict):
+        for item in value.values():
+            freeze(item)
+    return value
+
+class SelectionAggregateCache:
+    def __init__(self, max_megabytes = MAX_MEGABYTES):
+        self.max_bytes = int(max_megabytes * 1024 * 1024)
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits = self.hits + 1
+                return self.entries[key][0]
+            self.misses = self.misses + 1
+        value = freeze(compute())
+        self.__store(key, value)
+        return value
+
+    def __store(self, key, value):
+        size = nbytes(value)
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes = self.current_bytes - self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return # større enn hele taket, brukes bare i denne kjøringen
+            self.entries[key] = (value, size)
+            self.current_bytes = self.current_bytes + size
+            while self.current_bytes > self.max_bytes:
+                evicted_key, (evicted_value, evicted_size) = self.entries.popitem(last=False)
+                self.current_bytes = self.current_bytes - evicted_size
+                self.evictions = self.evictions + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "megabytes": round(self.current_bytes / 1024 / 1024, 1),
+                "max_megabytes": round(self.max_bytes / 1024 / 1024, 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,58 @@
+import hashlib
+import json
+import os
+import shutil
+import pandas as pd
+
+# Excel-arbeidsbøker parses én gang; hvert ark lagres som Parquet (pickle for blandede kolonner)
+# i en mappe navngitt etter innholdshashen til filen. Endres filen, får den en ny hash og parses på nytt.
+
+CACHE_FOLDER = "src/cache/workbooks"
+
+def file_hash(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+def _write_snapshot(file_path, snapshot_folder):
+    sheets = pd.read_excel(file_path, sheet_name = None)
+    temporary_folder = f"{snapshot_folder}.{os.getpid()}.tmp"
+    os.makedirs(temporary_folder, exist_ok = True)
+    manifest = {"source": os.path.basename(file_path), "sheets": []}
+    for i, (sheet_name, df) in enumerate(sheets.items()):
+        try:
+            df.to_parquet(os.path.join(temporary_folder, f"{i}.parquet"))
+            sheet_format = "parquet"
+        except Exception:
+            # f.eks. tall og '<Null>' i samme kolonne, eller kolonnenavn som ikke er tekst
+            df.to_pickle(os.path.join(temporary_folder, f"{i}.pkl"))
+            sheet_format = "pkl"
+        manifest["sheets"].append({"name": sheet_name, "file": f"{i}.{sheet_format}", "format": sheet_format})
+    with open(os.path.join(temporary_folder, "manifest.json"), "w", encoding = "utf-8") as file:
+        json.dump(manifest, file, ensure_ascii = False)
+    try:
+        os.rename(temporary_folder, snapshot_folder)
+    except OSError:
+        # en annen prosess rakk å skrive samme snapshot
+        shutil.rmtree(temporary_folder, ignore_errors = True)
+    return sheets
+
+def read_workbook(file_path, cache_folder = CACHE_FOLDER):
+    # samme resultat som pd.read_excel(file_path, sheet_name=None): {arknavn: DataFrame} i arkrekkefølge
+    snapshot_folder = os.path.join(cache_folder, file_hash(file_path))
+    manifest_file = os.path.join(snapshot_folder, "manifest.json")
+    if not os.path.exists(manifest_file):
+        os.makedirs(cache_folder, exist_ok = True)
+        return _write_snapshot(file_path, snapshot_folder)
+    with open(manifest_file, encoding = "utf-8") as file:
+        manifest = json.load(file)
+    sheets = {}
+    for sheet in manifest["sheets"]:
+        sheet_file = os.path.join(snapshot_folder, sheet["file"])
+        if sheet["format"] == "parquet":
+            sheets[sheet["name"]] = pd.read_parquet(sheet_file)
+        else:
+            sheets[sheet["name"]] = pd.read_pickle(sheet_file)
+    return sheets